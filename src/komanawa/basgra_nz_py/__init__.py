@@ -3,5 +3,9 @@ created matt_dumont
 on: 26/04/24
 """
 from komanawa.basgra_nz_py.version import __version__
-from komanawa.basgra_nz_py.basgra_python import run_basgra_nz
+from komanawa.basgra_nz_py.basgra_python import run_basgra_nz, run_basgra_nz_arrays, run_basgra_nz_batch, \
+    ValidatedInputs, BasgraSimulation, get_penman_terms, year_doy_to_datetime
+from komanawa.basgra_nz_py.spin_up import SpinUpCache, get_spin_up_state
+from komanawa.basgra_nz_py.result_cache import ResultCache
+from komanawa.basgra_nz_py.pool import BasgraPool
 from komanawa.basgra_nz_py.supporting_functions import woodward_2020_params, conversions, plotting
\ No newline at end of file
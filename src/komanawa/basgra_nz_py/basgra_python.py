@@ -4,113 +4,783 @@ This is a place to create a python wrapper for the BASGRA fortran model in forta
  Author: Matt Hanson
  Created: 12/08/2020 9:32 AM
  """
+import os
 import numpy as np
 import pandas as pd
 from copy import deepcopy
 from komanawa.basgra_nz_py.input_output_keys import param_keys, out_cols, days_harvest_keys, matrix_weather_keys_pet, \
-    matrix_weather_keys_penman
+    matrix_weather_keys_penman, state_keys
 from warnings import warn
 from komanawa.basgra_nz_py.get_fortran_module import get_fortran_basgra
 
-# this is the maximum number of weather days,
-# it is hard coded into fortran_BASGRA_NZ/environment.f95 line 9
-_max_weather_size = 36600
+_agg_periods = ('month', 'water_year', 'year')
+_agg_stats = ('sum', 'mean', 'min', 'max')  # the order of the aggregated statistics in the fortran output
+_n_penman_terms = 3  # the number of weather only terms of the penman equation, see PENMAN_WEATHER in basgraf.f95
 
-
-def run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=False,
+def run_basgra_nz(params, matrix_weather, days_harvest=None, doy_irr=None, verbose=False,
                   supply_pet=True, auto_harvest=False, run_365_calendar=False, binname='gfortran-12', recompile=False,
-                  compile_verbose=False):
+                  compile_verbose=False, out_vars=None, aggregate=None, state=None, return_state=False):
     """
     python wrapper for the fortran BASGRA code changes to the fortran code may require changes to this function runs the model for the period of the weather data
 
+    The fortran model state is thread local and the GIL is released while the model runs, so independent runs can be
+    made concurrently from a thread pool (do not recompile while other threads are running the model).
+
     :param params: dictionary, see input_output_keys.py, https://github.com/Komanawa-Solutions-Ltd/BASGRA_NZ_PY for more details
-    :param matrix_weather: pandas dataframe of weather data, maximum entries set in _max_weather_size in line 24 of this file (currently 36600) see documentation for input columns at https://github.com/Komanawa-Solutions-Ltd/BASGRA_NZ_PY , note expected DOY will change depending on expect_no_leap_days
+    :param matrix_weather: pandas dataframe of weather data, there is no maximum length, see documentation for input columns at https://github.com/Komanawa-Solutions-Ltd/BASGRA_NZ_PY , note expected DOY will change depending on expect_no_leap_days. Alternatively a ValidatedInputs object, in which case days_harvest and doy_irr must be None, supply_pet, auto_harvest and run_365_calendar are taken from the ValidatedInputs object and only params are checked
     :param days_harvest: days harvest dataframe must be same length as matrix_weather entries see documentation for input columns at https://github.com/Komanawa-Solutions-Ltd/BASGRA_NZ_PY , note expected DOY will change depending on expect_no_leap_days
     :param doy_irr: a list of the days of year to irrigate on, must be integers acceptable values: (0-366)
     :param verbose: boolean, if True the fortran function prints a number of statements for debugging purposes(depreciated)
-    :param supply_pet: boolean, if True BASGRA expects pet to be supplied, if False the parameters required to calculate pet from the peyman equation are expected, the version must match the DLL if dll_path != 'default'
+    :param supply_pet: boolean, if True BASGRA expects pet to be supplied, if False the parameters required to calculate pet from the peyman equation are expected, both modes are supported by the same compiled kernel
     :param auto_harvest: boolean, if True then assumes data is formated correctly for auto harvesting, if False, then assumes data is formatted for manual harvesting (e.g. previous version) and re-formats internally
     :param run_365_calendar: boolean, if True then run on a 365 day calender This expects that all leap days will be removed from matrix_weather and days_harvest. DOY is expected to be between 1 and 365.  This means that datetime objects defined by year and doy will be incorrect. instead use get_month_day_to_nonleap_doy to map DOY to datetime via month and day. This is how the index of the returned datetime will be passed.  For example for date 2024-03-01 (2024 is a leap year) the dayofyear via a datetime object will be 61, but if expect_no_leap_days=True basgra expects day of year to be 60. the index of the results will be a datetime object of equivalent to 2024-03-01, so  the output doy will not match the index doy and there will be no value on 2020-02-29. default False
     :param binname: str, the name of the gfortran compiler to use, default 'gfortran-12'
     :param recompile: bool, if True force recompile the fortran code
     :param compile_verbose: bool, if True print the fortran compilation output
-    :return: pd.DataFrame(index=datetime index, columns = out_cols)
+    :param out_vars: None or list of output variables (see out_cols) to return, only these variables are stored by the fortran code, if None return all of out_cols
+    :param aggregate: None or one of 'month', 'water_year' (1 July - 30 June) or 'year'. If None return daily outputs, otherwise the fortran code accumulates the sum, mean, minimum and maximum of each output over each period as it runs, and one row is returned per period (partial periods at the start and end of the simulation are aggregated over the simulated days only)
+    :param state: None or dict/pd.Series of the model state (see state_keys) e.g. returned by a previous run with return_state=True. If None the run starts from the initial values in params, otherwise the run continues from the state (warm start), the weather and harvest data should start on the day after the end of the previous run. The params must be the same as the previous run (the parameters are not part of the state)
+    :param return_state: bool, if True also return the model state at the end of the run
+    :return: pd.DataFrame(index=datetime index, columns = out_cols (or out_vars)) or if aggregate is not None pd.DataFrame(index=period start date, columns = pd.MultiIndex(out_vars, ('sum', 'mean', 'min', 'max'))), if return_state (out, pd.Series(index=state_keys))
+    """
+
+    assert isinstance(verbose, bool), 'verbose must be boolean'
+    assert isinstance(return_state, bool), 'return_state must be boolean'
+
+    # test the input variables, the weather, harvest and irrigation data are only tested if not already validated
+    inputs = _get_validated_inputs(matrix_weather, days_harvest, doy_irr, supply_pet, auto_harvest, run_365_calendar)
+    _test_params(params)
+
+    out_vars, _ = _get_out_idx(out_vars)
+
+    # get variables into right python types
+    params = np.array([params[e] for e in param_keys]).astype(float)
+    _test_batch_params(params[np.newaxis], inputs)
+
+    if state is not None:
+        state = _get_state_array(state)
+    state_out = np.zeros(len(state_keys))
+
+    # the output dates come from the input year and doy as they may not be in out_vars
+    dates = inputs.dates
+
+    if aggregate is None:
+        y = run_basgra_nz_arrays(params, inputs.matrix_weather, inputs.days_harvest, inputs.doy_irr, verbose=verbose,
+                                 supply_pet=inputs.supply_pet, binname=binname, recompile=recompile,
+                                 compile_verbose=compile_verbose, out_vars=out_vars, state_in=state,
+                                 state_out=state_out, penman_terms=inputs.get_penman_terms(binname))
+        out = pd.DataFrame(y, pd.Index(dates, name='date'), out_vars)
+    else:
+        period, period_starts = _get_agg_periods(dates, aggregate)
+        y = run_basgra_nz_arrays(params, inputs.matrix_weather, inputs.days_harvest, inputs.doy_irr, verbose=verbose,
+                                 supply_pet=inputs.supply_pet, binname=binname, recompile=recompile,
+                                 compile_verbose=compile_verbose, out_vars=out_vars, period=period, state_in=state,
+                                 state_out=state_out, penman_terms=inputs.get_penman_terms(binname))
+        out = pd.DataFrame(y.reshape((len(period_starts), -1)), pd.Index(period_starts, name='period_start'),
+                           pd.MultiIndex.from_product([out_vars, _agg_stats]))
+
+    if return_state:
+        return out, pd.Series(state_out, index=list(state_keys), name='state')
+    return out
+
+
+def _get_state_array(state):
     """
+    convert and check a model state
+
+    :param state: dict/pd.Series of the model state (see state_keys)
+    :return: np.ndarray float64 shape (len(state_keys),) ordered as state_keys
+    """
+    missing = set(state_keys) - set(state.keys())
+    assert len(missing) == 0, f'missing state keys: {missing}'
+    extra = set(state.keys()) - set(state_keys)
+    assert len(extra) == 0, f'unknown state keys: {extra}'
+    state = np.array([state[k] for k in state_keys], dtype=float)
+    assert np.isfinite(state).all(), f'state must be finite, got nan/inf for: {np.array(state_keys)[~np.isfinite(state)]}'
+    return state
 
-    assert isinstance(supply_pet, bool), 'supply_pet param must be boolean'
-    assert isinstance(auto_harvest, bool), 'auto_harvest param must be boolean'
-    assert isinstance(run_365_calendar, bool), 'expect_no_leap_days must be boolean'
 
-    # define DLL library path
-    fortran_basgra = get_fortran_basgra(supply_pet, binname=binname, recomplile=recompile, verbose=compile_verbose)
+def _get_agg_periods(dates, aggregate):
+    """
+    get the aggregation period of each simulation day
 
-    # define expected weather keys
+    :param dates: pd.DatetimeIndex of the (consecutive) simulation days
+    :param aggregate: one of 'month', 'water_year' (1 July - 30 June) or 'year'
+    :return: period (np.ndarray int32, the 1 based period of each day), period_starts (pd.DatetimeIndex, the nominal start date of each period)
+    """
+    assert aggregate in _agg_periods, f'aggregate must be None or one of {_agg_periods}, got {aggregate}'
+    years = dates.year.values
+    months = dates.month.values
+
+    # key each day by the (year * 12 + month - 1) of the start of its period
+    if aggregate == 'month':
+        keys = years * 12 + months - 1
+    elif aggregate == 'water_year':
+        keys = (years - (months < 7)) * 12 + 6
+    else:
+        keys = years * 12
+
+    new_period = np.concatenate(([True], keys[1:] != keys[:-1]))
+    period = np.cumsum(new_period).astype(np.int32)
+    start_keys = keys[new_period]
+    period_starts = pd.to_datetime(pd.DataFrame({'year': start_keys // 12, 'month': start_keys % 12 + 1, 'day': 1}))
+    return period, pd.DatetimeIndex(period_starts)
+
+
+def run_basgra_nz_arrays(params, matrix_weather, days_harvest, doy_irr, out=None, verbose=False, supply_pet=True,
+                         binname='gfortran-12', recompile=False, compile_verbose=False, out_vars=None, period=None,
+                         state_in=None, state_out=None, record_layout=False, penman_terms=None):
+    """
+    low level fast path to the fortran BASGRA code which bypasses pandas entirely. The inputs must already be packed
+    into the layout expected by fortran, arrays in that layout are passed to fortran without any copies. Only the
+    array shapes and layouts are checked, the values are not validated, so it is best to check a representative set
+    of inputs with run_basgra_nz before using this function in an inner (e.g. calibration) loop.
+
+    :param params: np.ndarray float64 shape (len(param_keys),), ordered as param_keys
+    :param matrix_weather: np.ndarray float64 F ordered shape (ndays, len(matrix_weather_keys_pet)) or (ndays, len(matrix_weather_keys_penman)) (see supply_pet), columns ordered as the weather keys
+    :param days_harvest: the harvest data, either the sparse harvest events (harvest_day, harvest_events), see _get_harvest_events (and ValidatedInputs.days_harvest), or np.ndarray float64 F ordered shape (ndays, len(days_harvest_keys)), columns ordered as days_harvest_keys, in the auto harvest format (one row per day of matrix_weather, manual harvest data can be translated with _trans_manual_harv)
+    :param doy_irr: np.ndarray int32 shape (nirr,), the days of year to irrigate on
+    :param out: None or np.ndarray float64 F ordered (C ordered if record_layout) shape (ndays, len(out_vars)) (or (nperiods, len(out_vars), 4) if period is passed) which is overwritten with the results, if None a new array is created
+    :param verbose: boolean, see run_basgra_nz
+    :param supply_pet: boolean, see run_basgra_nz
+    :param binname: str, the name of the gfortran compiler to use, default 'gfortran-12'
+    :param recompile: bool, if True force recompile the fortran code
+    :param compile_verbose: bool, if True print the fortran compilation output
+    :param out_vars: None or list of output variables (see out_cols) to store, if None store all of out_cols
+    :param period: None (daily outputs) or np.ndarray int32 shape (ndays,) the 1 based aggregation period of each day, must start at 1 and increase by 0 or 1 each day. If passed the sum, mean, minimum and maximum of each output is accumulated over each period (see _get_agg_periods)
+    :param state_in: None or np.ndarray float64 shape (len(state_keys),) the model state to start from (see run_basgra_nz state), if None start from the initial values in params
+    :param state_out: None or np.ndarray float64 shape (len(state_keys),) which is overwritten with the model state at the end of the run (see state_keys)
+    :param record_layout: bool, if False (default) out is F ordered, each output variable is contiguous, which is the layout of pandas data frames. If True out is C ordered, the fortran code writes the outputs of each day (or period) as one contiguous record, which suits consumers that read the results day by day (or write them to row based formats)
+    :param penman_terms: None or np.ndarray float64 F ordered shape (ndays, 3) the weather only terms of the Penman equation for matrix_weather (see get_penman_terms), only used if not supply_pet. If None they are calculated on each call, pass them to avoid repeating the calculation for runs which share the same weather
+    :return: out, np.ndarray float64 F ordered (C ordered if record_layout) shape (ndays, len(out_vars)), columns ordered as out_vars (or out_cols), or if period is passed shape (nperiods, len(out_vars), 4) the last axis is ('sum', 'mean', 'min', 'max')
+    """
+    fortran_basgra = get_fortran_basgra(binname=binname, recomplile=recompile, verbose=compile_verbose)
     if supply_pet:
-        _matrix_weather_keys = matrix_weather_keys_pet
+        nweather = len(matrix_weather_keys_pet)
+    else:
+        nweather = len(matrix_weather_keys_penman)
+
+    out_vars, out_idx = _get_out_idx(out_vars)
+    ndays = matrix_weather.shape[0]
+    nout = len(out_vars)
+    _check_fortran_array(params, 'params', (len(param_keys),), float)
+    _check_fortran_array(matrix_weather, 'matrix_weather', (ndays, nweather), float)
+    if isinstance(days_harvest, tuple):
+        harvest_day, harvest_events = days_harvest
+        _check_harvest_events(harvest_day, harvest_events, ndays)
+    else:
+        # a harvest event on every day, the column slice of an F ordered array is not copied
+        _check_fortran_array(days_harvest, 'days_harvest', (ndays, len(days_harvest_keys)), float)
+        harvest_day, harvest_events = np.arange(1, ndays + 1, dtype=np.int32), days_harvest[:, 2:]
+    _check_doy_irr(doy_irr)
+    use_state = state_in is not None
+    if use_state:
+        _check_fortran_array(state_in, 'state_in', (len(state_keys),), float)
+    else:
+        state_in = np.zeros(len(state_keys))
+    if state_out is None:
+        state_out = np.zeros(len(state_keys))
     else:
-        _matrix_weather_keys = matrix_weather_keys_penman
+        _check_fortran_array(state_out, 'state_out', (len(state_keys),), float)
+    if penman_terms is None:
+        penman_terms = get_penman_terms(matrix_weather, supply_pet, binname)
+    else:
+        _check_fortran_array(penman_terms, 'penman_terms', (ndays, 0 if supply_pet else _n_penman_terms), float)
+    if period is None:
+        nrows, nstat = ndays, 1
+        period = np.arange(1, ndays + 1, dtype=np.int32)
+        out_shape = (ndays, nout)
+    else:
+        _check_agg_period(period, ndays)
+        nrows, nstat = int(period[-1]), len(_agg_stats)
+        out_shape = (nrows, nout, nstat)
+    order = 'C' if record_layout else 'F'
+    if out is None:
+        out = np.zeros(out_shape, float, order=order)
+    else:
+        _check_fortran_array(out, 'out', out_shape, float, order=order)
+
+    # every output is written for every row, so a re-used output buffer does not need to be reset, the flat view of
+    # out (in its own order) is passed to fortran without a copy
+    fortran_basgra.basgra(params, matrix_weather, len(harvest_day), harvest_day, harvest_events, ndays, nweather, nout,
+                          len(doy_irr), doy_irr, out_idx, nrows, nstat, period, penman_terms.shape[1], penman_terms,
+                          supply_pet, len(state_keys), state_in,
+                          use_state, record_layout, verbose, y=out.reshape(-1, order=order), state_out=state_out)
+    return out
 
-    doy_irr = np.atleast_1d(doy_irr)
-    # test the input variables
-    _test_basgra_inputs(params, matrix_weather, days_harvest, verbose, _matrix_weather_keys,
-                        auto_harvest, doy_irr, run_365_calendar=run_365_calendar)
 
-    nout = len(out_cols)
-    ndays = len(matrix_weather)
-    nirr = len(doy_irr)
+def get_penman_terms(matrix_weather, supply_pet=False, binname='gfortran-12'):
+    """
+    calculate the terms of the Penman equation which only depend on the weather (the net long wave radiation, the
+    slope of the saturated vapour pressure curve and the drying power of the air) for each day, in a single fortran
+    pass. These can be passed to run_basgra_nz_arrays (penman_terms) for many runs which share the same weather.
+
+    :param matrix_weather: np.ndarray float64 F ordered shape (ndays, len(matrix_weather_keys_penman)), see run_basgra_nz_arrays
+    :param supply_pet: boolean, see run_basgra_nz, if True PET is supplied so no terms are needed
+    :param binname: str, the name of the gfortran compiler to use, default 'gfortran-12'
+    :return: np.ndarray float64 F ordered shape (ndays, 3), or (ndays, 0) if supply_pet
+    """
+    ndays = matrix_weather.shape[0]
+    if supply_pet:
+        return np.zeros((ndays, 0), order='F')
+    _check_fortran_array(matrix_weather, 'matrix_weather', (ndays, len(matrix_weather_keys_penman)), float)
+    fortran_basgra = get_fortran_basgra(binname=binname)
+    penman_terms = np.zeros((ndays, _n_penman_terms), order='F')
+    fortran_basgra.penman_weather(matrix_weather, ndays, matrix_weather.shape[1], _n_penman_terms,
+                                  penman_terms=penman_terms)
+    return penman_terms
 
-    # define output indexes before data manipulation
-    out_index = matrix_weather.index
 
-    # copy everything and ensure order is correct
-    params = deepcopy(params)
-    matrix_weather = deepcopy(matrix_weather.loc[:, _matrix_weather_keys])
-    days_harvest = deepcopy(days_harvest.loc[:, days_harvest_keys])
+def _check_agg_period(period, ndays):
+    """
+    check the aggregation periods, these are used as indices in the fortran code so must be valid
 
-    # translate manual harvest inputs into fortran format
-    if not auto_harvest:
-        days_harvest = _trans_manual_harv(days_harvest, matrix_weather)
+    :param period: np.ndarray int32 shape (ndays,)
+    :param ndays: the number of simulation days
+    :return:
+    """
+    _check_fortran_array(period, 'period', (ndays,), np.int32)
+    step = np.diff(period)
+    assert period[0] == 1 and ((step == 0) | (step == 1)).all(), 'period must start at 1 and increase by 0 or 1 each day'
 
-    # get variables into right python types
-    params = np.array([params[e] for e in param_keys]).astype(float)
-    matrix_weather = matrix_weather.values.astype(float)
-    days_harvest = days_harvest.values.astype(float)
+
+def _check_harvest_events(harvest_day, harvest_events, ndays):
+    """
+    check the sparse harvest events, the fortran code steps through the events in order so the days must be sorted
+
+    :param harvest_day: np.ndarray int32 shape (nharv,), see _get_harvest_events
+    :param harvest_events: np.ndarray float64 F ordered shape (nharv, len(days_harvest_keys) - 2)
+    :param ndays: the number of simulation days
+    :return:
+    """
+    _check_fortran_array(harvest_day, 'harvest_day', (len(harvest_day),), np.int32)
+    _check_fortran_array(harvest_events, 'harvest_events', (len(harvest_day), len(days_harvest_keys) - 2), float)
+    if len(harvest_day) > 0:
+        assert harvest_day[0] >= 1 and harvest_day[-1] <= ndays, 'harvest_day must be between 1 and ndays'
+        assert (np.diff(harvest_day) >= 0).all(), 'harvest_day must be sorted (non-decreasing)'
+
+
+def _check_doy_irr(doy_irr):
+    """
+    check the days of year to irrigate on, these are used as indices in the fortran code so must be valid
+
+    :param doy_irr: np.ndarray int32 shape (nirr,)
+    :return:
+    """
+    _check_fortran_array(doy_irr, 'doy_irr', (len(doy_irr),), np.int32)
+    assert ((doy_irr >= 0) & (doy_irr <= 366)).all(), 'entries of doy_irr must be between 0 and 366'
+
+
+def _get_out_idx(out_vars):
+    """
+    get the fortran (1 based) indices of the requested output variables
+
+    :param out_vars: None (all of out_cols), a single output variable or a list of output variables (see out_cols)
+    :return: out_vars (list), out_idx (np.ndarray int32)
+    """
+    if out_vars is None:
+        out_vars = list(out_cols)
+    elif isinstance(out_vars, str):
+        out_vars = [out_vars]
+    else:
+        out_vars = list(out_vars)
+    assert len(out_vars) > 0, 'out_vars must not be empty'
+    bad_vars = set(out_vars) - set(out_cols)
+    assert len(bad_vars) == 0, f'unknown out_vars: {bad_vars}, see input_output_keys.out_cols for options'
+    assert len(set(out_vars)) == len(out_vars), 'out_vars must not contain duplicates'
+    out_idx = np.array([out_cols.index(e) + 1 for e in out_vars], np.int32)
+    return out_vars, out_idx
+
+
+def _check_fortran_array(array, name, shape, dtype, order='F'):
+    """
+    check that an array can be passed to fortran without a copy
+
+    :param array: the array to check
+    :param name: the name of the array (for error messages)
+    :param shape: the expected shape
+    :param dtype: the expected dtype
+    :param order: 'F' or 'C' the expected memory order
+    :return:
+    """
+    assert isinstance(array, np.ndarray), f'{name} must be a np.ndarray, got {type(array)}'
+    assert array.shape == shape, f'{name} must have shape {shape}, got {array.shape}'
+    assert array.dtype == np.dtype(dtype), f'{name} must have dtype {np.dtype(dtype)}, got {array.dtype}'
+    if order == 'F':
+        assert array.flags.f_contiguous, f'{name} must be F ordered (np.asfortranarray)'
+    else:
+        assert array.flags.c_contiguous, f'{name} must be C ordered (np.ascontiguousarray)'
+
+
+def run_basgra_nz_batch(params, matrix_weather, days_harvest=None, doy_irr=None, verbose=False,
+                        supply_pet=True, auto_harvest=False, run_365_calendar=False, binname='gfortran-12',
+                        recompile=False, compile_verbose=False, n_threads=1, out_vars=None, aggregate=None,
+                        record_layout=False):
+    """
+    run the fortran BASGRA code for a batch of parameter sets which share the same weather, harvest and irrigation data. The inputs are validated and converted once and all of the runs are completed in a single fortran call, which is much faster than calling run_basgra_nz for each parameter set.
+
+    :param params: the parameter sets for each run, one of:
+
+                   * list of dictionaries, see run_basgra_nz
+                   * pd.DataFrame, index = runs, columns = param_keys
+                   * np.ndarray, shape (nruns, len(param_keys)), columns ordered as param_keys
+
+    :param matrix_weather: pandas dataframe of weather data (or a ValidatedInputs object), see run_basgra_nz, shared by all runs
+    :param days_harvest: days harvest dataframe, see run_basgra_nz, shared by all runs
+    :param doy_irr: a list of the days of year to irrigate on, see run_basgra_nz, shared by all runs
+    :param verbose: boolean, see run_basgra_nz
+    :param supply_pet: boolean, see run_basgra_nz
+    :param auto_harvest: boolean, see run_basgra_nz
+    :param run_365_calendar: boolean, see run_basgra_nz
+    :param binname: str, the name of the gfortran compiler to use, default 'gfortran-12'
+    :param recompile: bool, if True force recompile the fortran code
+    :param compile_verbose: bool, if True print the fortran compilation output
+    :param n_threads: int or None, the number of OpenMP threads the runs are split across inside the fortran code, default 1 (serial), None uses all available cores (os.cpu_count())
+    :param out_vars: None or list of output variables (see out_cols) to store, if None store all of out_cols. Storing only the required variables greatly reduces the memory use of large batches
+    :param aggregate: None or one of 'month', 'water_year' or 'year', see run_basgra_nz
+    :param record_layout: bool, if False (default) the output of each run is F ordered (each output variable is contiguous), if True the output is C ordered (the outputs of each day are contiguous), see run_basgra_nz_arrays
+    :return: np.ndarray shape (nruns, ndays, nout), the last axis is ordered as out_vars (or out_cols) and the days match the rows of matrix_weather. If aggregate is not None the shape is (nruns, nperiods, nout, 4), the periods match the index of run_basgra_nz(..., aggregate=aggregate) and the last axis is ('sum', 'mean', 'min', 'max')
+    """
+    assert isinstance(verbose, bool), 'verbose must be boolean'
+    if n_threads is None:
+        n_threads = os.cpu_count()
+    assert isinstance(n_threads, int) and n_threads >= 1, 'n_threads must be None or an integer >= 1'
+
+    # test the shared inputs once (unless already validated) and then the parameters for each run
+    inputs = _get_validated_inputs(matrix_weather, days_harvest, doy_irr, supply_pet, auto_harvest, run_365_calendar)
+    params = _batch_params_to_array(params)
+    _test_batch_params(params, inputs)
+
+    fortran_basgra = get_fortran_basgra(binname=binname, recomplile=recompile, verbose=compile_verbose)
+
+    out_vars, out_idx = _get_out_idx(out_vars)
+    nout = len(out_vars)
+    ndays = len(inputs.dates)
+    nirr = len(inputs.doy_irr)
+    nruns = len(params)
+
+    if aggregate is None:
+        nrows, nstat = ndays, 1
+        period = np.arange(1, ndays + 1, dtype=np.int32)
+    else:
+        period, period_starts = _get_agg_periods(inputs.dates, aggregate)
+        nrows, nstat = len(period_starts), len(_agg_stats)
+
+    # cannot set these to nan's or it breaks fortran
+    y = _get_batch_out_array(nruns, nrows, nout, nstat, record_layout)
+    harvest_day, harvest_events = inputs.days_harvest
+    penman_terms = inputs.get_penman_terms(binname)  # calculated once and shared by all of the runs
+    fortran_basgra.basgra_batch(np.asfortranarray(params.T),
+                                    inputs.matrix_weather,
+                                    len(harvest_day),
+                                    harvest_day,
+                                    harvest_events,
+                                    ndays,
+                                    inputs.matrix_weather.shape[1],
+                                    nout,
+                                    nirr,
+                                    inputs.doy_irr,
+                                    out_idx,
+                                    nrows,
+                                    nstat,
+                                    period,
+                                    penman_terms.shape[1],
+                                    penman_terms,
+                                    inputs.supply_pet,
+                                    nruns,
+                                    min(n_threads, nruns),
+                                    record_layout,
+                                    verbose,
+                                    y=_get_batch_fortran_view(y))
+
+    if aggregate is None:
+        y = y[..., 0]
+    return y
+
+
+def _get_batch_out_array(nruns, nrows, nout, nstat, record_layout):
+    """
+    get a zeroed batch output array, each run is contiguous in memory in the layout set by record_layout
+
+    :param nruns: int the number of runs
+    :param nrows: int the number of output rows
+    :param nout: int the number of output variables
+    :param nstat: int the number of statistics
+    :param record_layout: bool, see run_basgra_nz_arrays
+    :return: np.ndarray shape (nruns, nrows, nout, nstat)
+    """
+    if record_layout:
+        return np.zeros((nruns, nrows, nout, nstat), float)
+    # (nrows, nout, nstat, nruns) -> (nruns, nrows, nout, nstat) without a copy
+    return np.moveaxis(np.zeros((nrows, nout, nstat, nruns), float, order='F'), -1, 0)
+
+
+def _get_batch_fortran_view(y):
+    """
+    get the (nrows * nout * nstat, nruns) F ordered view of (a contiguous block of runs of) a batch output array
+
+    :param y: np.ndarray shape (nruns, nrows, nout, nstat), see _get_batch_out_array
+    :return: np.ndarray shape (nrows * nout * nstat, nruns), which shares memory with y
+    """
+    nruns = y.shape[0]
+    if y.flags.c_contiguous:  # record layout
+        return y.reshape((nruns, -1)).T
+    return np.moveaxis(y, 0, -1).reshape((-1, nruns), order='F')
+
+
+def _batch_params_to_array(params):
+    """
+    convert the batch parameter sets to a float array
+
+    :param params: list of dictionaries, pd.DataFrame (columns=param_keys) or np.ndarray (nruns, len(param_keys))
+    :return: np.ndarray shape (nruns, len(param_keys)), C ordered
+    """
+    if isinstance(params, pd.DataFrame):
+        assert set(params.columns) == set(param_keys), 'incorrect params keys'
+        params = params.loc[:, list(param_keys)].values
+    elif isinstance(params, np.ndarray):
+        pass
+    else:
+        params = list(params)
+        for p in params:
+            assert isinstance(p, dict), 'params must be a list of dictionaries, a pd.DataFrame or a np.ndarray'
+            assert set(p.keys()) == set(param_keys), 'incorrect params keys'
+        params = [[p[e] for e in param_keys] for p in params]
+    params = np.ascontiguousarray(params, dtype=float)
+    assert params.ndim == 2, 'params must be 2d (nruns, nparams)'
+    assert params.shape[1] == len(param_keys), f'params must have {len(param_keys)} columns, got {params.shape[1]}'
+    assert params.shape[0] > 0, 'params must contain at least one parameter set'
+    return params
+
+
+def _test_batch_params(params, inputs):
+    """
+    vectorised checks of the parameters, including the checks which depend on the (validated) weather and harvest data
+
+    :param params: np.ndarray (nruns, len(param_keys))
+    :param inputs: ValidatedInputs
+    :return:
+    """
+    pidx = {k: i for i, k in enumerate(param_keys)}
+    assert not np.isnan(params).any(), 'params cannot have na data'
+    assert (params[:, pidx['reseed_harv_delay']] >= 1).all(), 'harvest delay must be >=1'
+    if (params[:, pidx['fixed_removal']] > 0.9).any():
+        assert inputs.harv_trig_ge_targ, 'when using fixed harvest mode the harv_trig>=harv_targ'
+
+    # pass a warning if max_irr is greater than abs_max_irr
+    abs_max_irr = params[:, pidx['abs_max_irr']].min()
+    if inputs.max_irr > abs_max_irr:
+        run_mess = ' for at least one run' if len(params) > 1 else ''
+        warn(f'maximum weather_matrix max_irr ({inputs.max_irr}) > absolute maximum '
+             f'irrigation {abs_max_irr}{run_mess}.  The extra irrigation can never be applied but may be '
+             f'available for storage.')
+
+
+class ValidatedInputs(object):
+    """
+    weather, harvest and irrigation data which have been validated and packed into the arrays expected by fortran once.
+    Pass this object in place of matrix_weather to run_basgra_nz or run_basgra_nz_batch (with days_harvest=None and
+    doy_irr=None) to avoid repeating the input checks on every call, only the parameters are then checked. This is
+    useful for optimisers which run the model many times with the same weather. The packed arrays are read only so that
+    they cannot be changed after they have been validated. They can also be passed directly to run_basgra_nz_arrays.
+    """
+
+    def __init__(self, matrix_weather, days_harvest, doy_irr, supply_pet=True, auto_harvest=False,
+                 run_365_calendar=False):
+        """
+
+        :param matrix_weather: pandas dataframe of weather data, see run_basgra_nz
+        :param days_harvest: days harvest dataframe, see run_basgra_nz
+        :param doy_irr: a list of the days of year to irrigate on, see run_basgra_nz
+        :param supply_pet: boolean, see run_basgra_nz
+        :param auto_harvest: boolean, see run_basgra_nz
+        :param run_365_calendar: boolean, see run_basgra_nz
+        """
+        assert isinstance(supply_pet, bool), 'supply_pet param must be boolean'
+        assert isinstance(auto_harvest, bool), 'auto_harvest param must be boolean'
+        assert isinstance(run_365_calendar, bool), 'expect_no_leap_days must be boolean'
+        self.supply_pet = supply_pet
+        self.auto_harvest = auto_harvest
+        self.run_365_calendar = run_365_calendar
+
+        if supply_pet:
+            _matrix_weather_keys = matrix_weather_keys_pet
+        else:
+            _matrix_weather_keys = matrix_weather_keys_penman
+
+        doy_irr = np.atleast_1d(doy_irr)
+        _test_basgra_inputs(matrix_weather, days_harvest, _matrix_weather_keys, auto_harvest, doy_irr,
+                            run_365_calendar=run_365_calendar)
+
+        # summaries needed to check the parameters against the inputs
+        self.max_irr = matrix_weather.loc[:, 'max_irr'].max()
+        self.harv_trig_ge_targ = bool((days_harvest['harv_trig'] >= days_harvest['harv_targ']).all())
+
+        matrix_weather, days_harvest, doy_irr = _prep_fortran_inputs(matrix_weather, days_harvest, doy_irr,
+                                                                     _matrix_weather_keys, auto_harvest)
+        for array in (matrix_weather, *days_harvest, doy_irr):
+            array.flags.writeable = False
+        self.matrix_weather = matrix_weather
+        self.days_harvest = days_harvest
+        self.doy_irr = doy_irr
+        self.dates = year_doy_to_datetime(matrix_weather[:, 0], matrix_weather[:, 1], run_365_calendar)
+        self._penman_terms = None
+
+    def get_penman_terms(self, binname='gfortran-12'):
+        """
+        get the weather only terms of the Penman equation (see get_penman_terms), these are calculated on the first
+        call and then shared by every run which uses these inputs
+
+        :param binname: str, the name of the gfortran compiler to use, default 'gfortran-12'
+        :return: np.ndarray float64 F ordered (read only) shape (ndays, 3), or (ndays, 0) if supply_pet
+        """
+        if self._penman_terms is None:
+            penman_terms = get_penman_terms(self.matrix_weather, self.supply_pet, binname)
+            penman_terms.flags.writeable = False
+            self._penman_terms = penman_terms
+        return self._penman_terms
+
+
+class BasgraSimulation(object):
+    """
+    step-wise (incremental) BASGRA simulation, e.g. for coupling BASGRA to an external (hydrology) model which exchanges
+    data with BASGRA every n days. Each call to step runs the model for the next n days and resumes from the model
+    state at the end of the previous step (see run_basgra_nz state), so the cost of a coupled run scales linearly with
+    the number of simulated days rather than re-running from the start of the simulation at every exchange. The
+    concatenated outputs of the steps match a single run over the whole period.
+
+    The model state (self.state, see input_output_keys.state_keys) may be modified between steps (e.g. to set the soil
+    water (WAL) from the external model).
+    """
+
+    def __init__(self, params, days_harvest, doy_irr, supply_pet=True, auto_harvest=False, run_365_calendar=False,
+                 out_vars=None, state=None, verbose=False, binname='gfortran-12', recompile=False,
+                 compile_verbose=False):
+        """
+
+        :param params: dictionary, see run_basgra_nz, used for every step
+        :param days_harvest: days harvest dataframe, see run_basgra_nz, it may span the whole simulation (or more), the
+                             rows for the days of each step are selected by date. If auto_harvest it must contain a row
+                             for every simulated day
+        :param doy_irr: a list of the days of year to irrigate on, see run_basgra_nz
+        :param supply_pet: boolean, see run_basgra_nz
+        :param auto_harvest: boolean, see run_basgra_nz
+        :param run_365_calendar: boolean, see run_basgra_nz
+        :param out_vars: None or list of output variables (see out_cols) to return from each step
+        :param state: None (start from the initial values in params) or dict/pd.Series of the model state to start from, see run_basgra_nz
+        :param verbose: boolean, see run_basgra_nz
+        :param binname: str, the name of the gfortran compiler to use, default 'gfortran-12'
+        :param recompile: bool, if True force recompile the fortran code (on the first step only)
+        :param compile_verbose: bool, if True print the fortran compilation output
+        """
+        assert isinstance(supply_pet, bool), 'supply_pet param must be boolean'
+        assert isinstance(auto_harvest, bool), 'auto_harvest param must be boolean'
+        assert isinstance(run_365_calendar, bool), 'expect_no_leap_days must be boolean'
+        assert isinstance(verbose, bool), 'verbose must be boolean'
+        _test_params(params)
+        _test_days_harvest(days_harvest, run_365_calendar)
+        assert len(days_harvest) > 0, 'days_harvest must have at least one row'
+        doy_irr = np.atleast_1d(doy_irr)
+        _test_doy_irr(doy_irr)
+        if params['fixed_removal'] > 0.9:
+            assert (days_harvest['harv_trig'] >= days_harvest['harv_targ']).all(), (
+                'when using fixed harvest mode the harv_trig>=harv_targ')
+
+        self.params = deepcopy(params)
+        self.doy_irr = doy_irr
+        self.supply_pet = supply_pet
+        self.auto_harvest = auto_harvest
+        self.run_365_calendar = run_365_calendar
+        self.out_vars, _ = _get_out_idx(out_vars)
+        self.verbose = verbose
+        self.binname = binname
+        self.recompile = recompile
+        self.compile_verbose = compile_verbose
+
+        # the inputs which are shared by every step are packed into the arrays expected by fortran once, each step then
+        # only selects its harvest events (see _get_harvest) and goes straight to run_basgra_nz_arrays
+        if supply_pet:
+            self._matrix_weather_keys = matrix_weather_keys_pet
+        else:
+            self._matrix_weather_keys = matrix_weather_keys_penman
+        self._params = np.array([params[e] for e in param_keys]).astype(float)
+        self._doy_irr = doy_irr.astype(np.int32)
+        harvest_dates = year_doy_to_datetime(days_harvest.year.values, days_harvest.doy.values, run_365_calendar)
+        order = np.argsort(harvest_dates, kind='stable')
+        self._harvest_dates = harvest_dates[order]
+        self._harvest_events = np.asfortranarray(days_harvest.iloc[order].loc[:, list(days_harvest_keys[2:])].values,
+                                                 dtype=float)
+
+        if state is not None:
+            state = pd.Series(_get_state_array(state), index=list(state_keys), name='state')
+        self.state = state
+        self.last_date = None  # the last simulated day
+        self.ndays = 0  # the number of simulated days
+
+    def step(self, n_days, weather_rows):
+        """
+        run the model for the next n_days
+
+        :param n_days: int, the number of days to simulate
+        :param weather_rows: pandas dataframe of weather data for the next n_days (see run_basgra_nz matrix_weather), it must start on the day after the last simulated day
+        :return: pd.DataFrame(index=datetime index, columns = out_vars), the outputs for the simulated days
+        """
+        assert isinstance(n_days, (int, np.integer)) and n_days >= 1, 'n_days must be an integer >= 1'
+        assert isinstance(weather_rows, pd.DataFrame)
+        assert len(weather_rows) == n_days, f'weather_rows must have n_days ({n_days}) rows, got {len(weather_rows)}'
+        dates, _ = _test_matrix_weather(weather_rows, self._matrix_weather_keys, self.run_365_calendar)
+        if self.last_date is not None:
+            expected = self.last_date + pd.Timedelta(days=1)
+            if self.run_365_calendar and expected.month == 2 and expected.day == 29:
+                expected += pd.Timedelta(days=1)
+            assert dates[0] == expected, (f'weather_rows must start on the day after the last simulated day '
+                                          f'({expected.date()}), got {dates[0].date()}')
+
+        max_irr = weather_rows['max_irr'].max()
+        if max_irr > self.params['abs_max_irr']:
+            warn(f'maximum weather_matrix max_irr ({max_irr}) > absolute maximum irrigation '
+                 f'{self.params["abs_max_irr"]}.  The extra irrigation can never be applied but may be available '
+                 f'for storage.')
+
+        matrix_weather = np.asfortranarray(weather_rows.loc[:, self._matrix_weather_keys].values, dtype=float)
+        if self.recompile and self.ndays == 0:
+            get_fortran_basgra(binname=self.binname, recomplile=True, verbose=self.compile_verbose)
+        # each weather day belongs to exactly one step, so the weather only Penman terms are calculated once per day
+        penman_terms = get_penman_terms(matrix_weather, self.supply_pet, self.binname)
+        state_in = None if self.state is None else _get_state_array(self.state)
+        state_out = np.zeros(len(state_keys))
+        y = run_basgra_nz_arrays(self._params, matrix_weather, self._get_harvest(dates), self._doy_irr,
+                                 verbose=self.verbose, supply_pet=self.supply_pet, binname=self.binname,
+                                 compile_verbose=self.compile_verbose, out_vars=self.out_vars, state_in=state_in,
+                                 state_out=state_out, penman_terms=penman_terms)
+        self.state = pd.Series(state_out, index=list(state_keys), name='state')
+        self.last_date = dates[-1]
+        self.ndays += n_days
+        return pd.DataFrame(y, pd.Index(dates, name='date'), self.out_vars)
+
+    def _get_harvest(self, dates):
+        """
+        get the sparse harvest events (see _get_harvest_events) for the days of a step
+
+        :param dates: pd.DatetimeIndex of the (consecutive) days of the step
+        :return: harvest_day, harvest_events
+        """
+        start = np.searchsorted(self._harvest_dates, dates[0], side='left')
+        stop = np.searchsorted(self._harvest_dates, dates[-1], side='right')
+        harvest_events = np.asfortranarray(self._harvest_events[start:stop])
+        if self.auto_harvest:
+            assert stop - start == len(dates) and (self._harvest_dates[start:stop] == dates).all(), (
+                'days_harvest must contain one row for every simulated day when auto_harvest')
+            return np.arange(1, len(dates) + 1, dtype=np.int32), harvest_events
+
+        harvest_day = (np.searchsorted(dates, self._harvest_dates[start:stop]) + 1).astype(np.int32)
+        if len(harvest_day) and harvest_day[0] == 1:
+            return harvest_day, harvest_events
+
+        # manual harvest, add a no harvest event on the first day of the step which carries the weed_dm_frac of the
+        # last harvest before the step, as the weed_dm_frac is forward filled in a single run (see _get_harvest_events)
+        harv_cols = list(days_harvest_keys[2:])
+        first = {
+            'frac_harv': 0.,
+            'harv_trig': -1.,  # do not harvest
+            'harv_targ': -1.,
+            'weed_dm_frac': self._harvest_events[max(start - 1, 0), harv_cols.index('weed_dm_frac')],
+            'reseed_trig': -1.,  # do not reseed
+            'reseed_basal': 0.,
+        }
+        first = np.array([[first[k] for k in harv_cols]])
+        harvest_day = np.concatenate(([1], harvest_day)).astype(np.int32)
+        return harvest_day, np.asfortranarray(np.concatenate((first, harvest_events)))
+
+
+def _get_validated_inputs(matrix_weather, days_harvest, doy_irr, supply_pet, auto_harvest, run_365_calendar):
+    """
+    validate the weather, harvest and irrigation data, unless they have already been validated
+
+    :param matrix_weather: pandas dataframe of weather data or ValidatedInputs
+    :param days_harvest: days harvest dataframe or None (if matrix_weather is ValidatedInputs)
+    :param doy_irr: the days of year to irrigate on or None (if matrix_weather is ValidatedInputs)
+    :param supply_pet: boolean, see run_basgra_nz
+    :param auto_harvest: boolean, see run_basgra_nz
+    :param run_365_calendar: boolean, see run_basgra_nz
+    :return: ValidatedInputs
+    """
+    if isinstance(matrix_weather, ValidatedInputs):
+        assert days_harvest is None and doy_irr is None, ('days_harvest and doy_irr must be None when matrix_weather '
+                                                          'is a ValidatedInputs object')
+        return matrix_weather
+    assert days_harvest is not None and doy_irr is not None, 'days_harvest and doy_irr must be passed'
+    return ValidatedInputs(matrix_weather, days_harvest, doy_irr, supply_pet=supply_pet, auto_harvest=auto_harvest,
+                           run_365_calendar=run_365_calendar)
+
+
+def _prep_fortran_inputs(matrix_weather, days_harvest, doy_irr, _matrix_weather_keys, auto_harvest):
+    """
+    convert the (validated) weather, harvest and irrigation data into the arrays expected by fortran
+
+    :param matrix_weather: weather data
+    :param days_harvest: harvest data
+    :param doy_irr: np.ndarray of the days of year to irrigate on
+    :param _matrix_weather_keys: the expected weather keys (in fortran order)
+    :param auto_harvest: boolean, if False then days_harvest is in the manual harvest format
+    :return: matrix_weather (float, F ordered), days_harvest (harvest_day, harvest_events) see _get_harvest_events, doy_irr (int32)
+    """
+    # get variables into right python types, the weather is passed with exactly ndays rows (no padding)
+    matrix_weather = np.asfortranarray(matrix_weather.loc[:, _matrix_weather_keys].values, dtype=float)
+    days_harvest = _get_harvest_events(days_harvest.loc[:, list(days_harvest_keys)], matrix_weather, auto_harvest)
     doy_irr = doy_irr.astype(np.int32)
 
-    # manage weather size,
-    weather_size = len(matrix_weather)
-    if weather_size < _max_weather_size:
-        temp = np.zeros((_max_weather_size - weather_size, matrix_weather.shape[1]), float)
-        matrix_weather = np.concatenate((matrix_weather, temp), 0)
-    elif weather_size > _max_weather_size:
-        raise ValueError(f'weather data is too long, maximum is {_max_weather_size} days, '
-                         f'though this value can be modified in the fortran code: '
-                         f'fortran_BASGRA_NZ/environment.f95 line 9 and {__file__} line 29')
-
-    y = np.asfortranarray(np.zeros((ndays, nout), float))  # cannot set these to nan's or it breaks fortran
-
-    y = fortran_basgra.basgra(params,
-                              np.asfortranarray(matrix_weather),
-                              days_harvest,
-                              ndays,
-                              nout,
-                              nirr,
-                              doy_irr,
-                              verbose,
-                              y=deepcopy(y))
-    out = pd.DataFrame(y, out_index, out_cols)
-    if run_365_calendar:
-        mapper = get_month_day_to_nonleap_doy(key_doy=True)
-        strs = [f'{y}-{mapper[doy][0]:02d}-{mapper[doy][1]:02d}' for y, doy in zip(out.year.values.astype(int),
-                                                                                   out.doy.values.astype(int))]
-        out.loc[:, 'date'] = pd.to_datetime(strs)
+    return matrix_weather, days_harvest, doy_irr
+
+
+def _get_harvest_day_index(days_harvest, years, doys):
+    """
+    get the 0 based day (row) of matrix_weather of each harvest
+
+    :param days_harvest: harvest data with year and doy columns
+    :param years: year of each weather day
+    :param doys: day of year of each weather day
+    :return: np.ndarray int of the row of each harvest (in the order of days_harvest)
+    """
+    # the weather days are consecutive so the (year, doy) keys are sorted
+    ndays = len(years)
+    weather_keys = np.asarray(years).astype(np.int64) * 1000 + np.asarray(doys).astype(np.int64)
+    harvest_keys = (days_harvest['year'].values.astype(np.int64) * 1000
+                    + days_harvest['doy'].values.astype(np.int64))
+    day_idx = np.searchsorted(weather_keys, harvest_keys)
+    assert (day_idx < ndays).all() and (weather_keys[day_idx.clip(max=ndays - 1)] == harvest_keys).all(), (
+        'days_harvest contains days which are not in matrix_weather')
+    return day_idx
+
+
+def _get_harvest_events(days_harvest, matrix_weather, auto_harvest):
+    """
+    convert the (validated) harvest data into the sparse harvest events expected by fortran, only the days with
+    harvest data are passed, so the size scales with the number of harvests rather than the number of days. On days
+    without an event fortran does not harvest or reseed and keeps the weed_dm_frac of the last event (or the first
+    event before it), which is equivalent to _trans_manual_harv.
+
+    :param days_harvest: harvest data, columns ordered as days_harvest_keys
+    :param matrix_weather: np.ndarray of the weather data (fortran format), to get the day of each event
+    :param auto_harvest: boolean, if True days_harvest has one row per day of matrix_weather
+    :return: harvest_day (np.ndarray int32 shape (nharv,) the sorted, 1 based simulation day of each event), harvest_events (np.ndarray float64 F ordered shape (nharv, len(days_harvest_keys) - 2), columns ordered as days_harvest_keys[2:])
+    """
+    ndays = len(matrix_weather)
+    if auto_harvest:
+        harvest_day = np.arange(1, ndays + 1, dtype=np.int32)
     else:
-        strs = ['{}-{:03d}'.format(int(e), int(f)) for e, f in out[['year', 'doy']].itertuples(False, None)]
-        out.loc[:, 'date'] = pd.to_datetime(strs, format='%Y-%j')
+        day_idx = _get_harvest_day_index(days_harvest, matrix_weather[:, 0], matrix_weather[:, 1])
 
-    out.set_index('date', inplace=True)
+        # a stable sort so that the last of any duplicate days is applied (as _trans_manual_harv)
+        order = np.argsort(day_idx, kind='stable')
+        days_harvest = days_harvest.iloc[order]
+        harvest_day = (day_idx[order] + 1).astype(np.int32)
+        if harvest_day[0] != 1:
+            warn('weed_dm_frac is na for the first day of simulation, setting to first valid weed_dm_frac\n'
+                 'this does not affect the harvesting only the calculation of the DMH_weed variable.')
 
-    return out
+    harvest_events = np.asfortranarray(days_harvest.iloc[:, 2:].values, dtype=float)
+    return harvest_day, harvest_events
 
 
 def _trans_manual_harv(days_harvest, matrix_weather):
@@ -121,41 +791,48 @@ def _trans_manual_harv(days_harvest, matrix_weather):
     :param matrix_weather: weather data, mostly to get the right size
     :return: days_harvest (correct format for fortran code)
     """
-    days_harvest = days_harvest.set_index(['year', 'doy'])
-    days_harvest_out = pd.DataFrame({'year': matrix_weather.loc[:, 'year'],
-                                     'doy': matrix_weather.loc[:, 'doy'],
-                                     'frac_harv': np.zeros(len(matrix_weather)),  # set filler values
-                                     'harv_trig': np.zeros(len(matrix_weather)) - 1,  # set flag to not harvest
-                                     'harv_targ': np.zeros(len(matrix_weather)),  # set filler values
-                                     'weed_dm_frac': np.zeros(len(matrix_weather)) * np.nan,  # set nas, filled later
-                                     'reseed_trig': np.zeros(len(matrix_weather)) - 1,  # set flag to not reseed
-                                     'reseed_basal': np.zeros(len(matrix_weather)),  # set filler values
-                                     })
-    days_harvest_out = days_harvest_out.set_index(['year', 'doy'])
-    for k in set(days_harvest_keys) - {'year', 'doy'}:
-        days_harvest_out.loc[days_harvest.index, k] = days_harvest.loc[:, k]
-
-    days_harvest_out = days_harvest_out.reset_index()
+    ndays = len(matrix_weather)
+    years = matrix_weather.loc[:, 'year'].values
+    doys = matrix_weather.loc[:, 'doy'].values
+
+    day_idx = _get_harvest_day_index(days_harvest, years, doys)
+
+    # scatter the harvest data into a full length array of filler values
+    filler_values = {
+        'frac_harv': 0,  # set filler values
+        'harv_trig': -1,  # set flag to not harvest
+        'harv_targ': 0,  # set filler values
+        'weed_dm_frac': np.nan,  # set nas, filled later
+        'reseed_trig': -1,  # set flag to not reseed
+        'reseed_basal': 0,  # set filler values
+    }
+    harv_cols = days_harvest_keys[2:]
+    data = np.empty((ndays, len(harv_cols)))
+    for i, k in enumerate(harv_cols):
+        data[:, i] = filler_values[k]
+        data[day_idx, i] = days_harvest.loc[:, k].values
 
     # fill the weed fraction so that DMH_WEED is always calculated
-
-    if pd.isna(days_harvest_out.weed_dm_frac).iloc[0]:
+    weed_dm_frac = data[:, harv_cols.index('weed_dm_frac')]
+    valid = ~np.isnan(weed_dm_frac)
+    if not valid[0]:
         warn('weed_dm_frac is na for the first day of simulation, setting to first valid weed_dm_frac\n'
              'this does not affect the harvesting only the calculation of the DMH_weed variable.')
+        weed_dm_frac[0] = weed_dm_frac[np.where(valid)[0][0]]  # get first non-nan value
+        valid[0] = True
 
-        idx = np.where(pd.notna(days_harvest_out.weed_dm_frac))[0][0]  # get first non-nan value
-        id_val = pd.Series(days_harvest_out.index).iloc[0]
-        days_harvest_out.loc[id_val, 'weed_dm_frac'] = days_harvest_out.loc[:, 'weed_dm_frac'].iloc[idx]
+    # forward fill, each day takes the value of the last valid day
+    weed_dm_frac[:] = weed_dm_frac[np.maximum.accumulate(np.where(valid, np.arange(ndays), 0))]
 
-    days_harvest_out.loc[:, 'weed_dm_frac'] = days_harvest_out.loc[:, 'weed_dm_frac'].ffill()
+    days_harvest_out = pd.DataFrame(data, columns=list(harv_cols))
+    days_harvest_out.insert(0, 'doy', doys)
+    days_harvest_out.insert(0, 'year', years)
 
     return days_harvest_out
 
 
-def _test_basgra_inputs(params, matrix_weather, days_harvest, verbose, _matrix_weather_keys,
-                        auto_harvest, doy_irr, run_365_calendar):
+def _test_params(params):
     # check parameters
-    assert isinstance(verbose, bool), 'verbose must be boolean'
     assert isinstance(params, dict)
     assert set(params.keys()) == set(param_keys), 'incorrect params keys'
     assert not any([np.isnan(e) for e in params.values()]), 'params cannot have na data'
@@ -163,46 +840,75 @@ def _test_basgra_inputs(params, matrix_weather, days_harvest, verbose, _matrix_w
     assert params['reseed_harv_delay'] >= 1, 'harvest delay must be >=1'
     assert params['reseed_harv_delay'] % 1 < 1e5, 'harvest delay must effectively be an integer'
 
-    # check matrix weather
+
+def _test_basgra_inputs(matrix_weather, days_harvest, _matrix_weather_keys, auto_harvest, doy_irr, run_365_calendar):
+    expected_datetimes, addmess = _test_matrix_weather(matrix_weather, _matrix_weather_keys, run_365_calendar)
+    _test_days_harvest(days_harvest, run_365_calendar)
+
+    if auto_harvest:
+        assert len(matrix_weather) == len(
+            days_harvest), 'days_harvest and matrix_weather must be the same length(ndays)'
+
+        check = (days_harvest['year'].values == matrix_weather.year.values).all() and (
+                days_harvest['doy'].values == matrix_weather.doy.values).all()
+        assert check, 'the date range of days_harvest does not match matrix_weather' + addmess
+    else:
+        harvest_dt = year_doy_to_datetime(days_harvest.year.values, days_harvest.doy.values, run_365_calendar)
+        assert harvest_dt.min() >= expected_datetimes.min(), 'days_harvest must start at or after first day of simulation'
+        assert harvest_dt.max() <= expected_datetimes.max(), 'days_harvest must stop at or before last day of simulation'
+
+    _test_doy_irr(doy_irr)
+
+
+def _test_matrix_weather(matrix_weather, _matrix_weather_keys, run_365_calendar):
+    """
+    check the weather data
+
+    :param matrix_weather: pandas dataframe of weather data
+    :param _matrix_weather_keys: the expected weather keys
+    :param run_365_calendar: boolean, see run_basgra_nz
+    :return: expected_datetimes (pd.DatetimeIndex of the simulated days), addmess (str, extra assertion message)
+    """
     assert isinstance(matrix_weather, pd.DataFrame)
     assert set(matrix_weather.keys()) == set(_matrix_weather_keys), 'incorrect keys for matrix_weather'
     assert pd.api.types.is_integer_dtype(matrix_weather.doy), 'doy must be an integer datatype in matrix_weather'
     assert pd.api.types.is_integer_dtype(matrix_weather.year), 'year must be an integer datatype in matrix_weather'
-    assert len(matrix_weather) <= _max_weather_size, 'maximum run size is {} days'.format(_max_weather_size)
     assert not matrix_weather.isna().any().any(), 'matrix_weather cannot have na values'
 
     # check to make sure there are no missing days in matrix_weather
-    start_year = matrix_weather['year'].min()
-    start_day = matrix_weather.loc[matrix_weather.year == start_year, 'doy'].min()
-
-    stop_year = matrix_weather['year'].max()
-    stop_day = matrix_weather.loc[matrix_weather.year == stop_year, 'doy'].max()
+    years = matrix_weather['year'].values
+    doys = matrix_weather['doy'].values
+    if run_365_calendar:
+        assert doys.max() <= 365, 'expected to have leap days removed, and all doy between 1-365'
+    dates = year_doy_to_datetime(years, doys, run_365_calendar)
+    start, stop = dates.min(), dates.max()
 
     if run_365_calendar:
-        assert matrix_weather.doy.max() <= 365, 'expected to have leap days removed, and all doy between 1-365'
-        doy_day_mapper = get_month_day_to_nonleap_doy()
-        inv_doy_mapper = get_month_day_to_nonleap_doy(key_doy=True)
-        start_mon, start_dom = inv_doy_mapper[start_day]
-        stop_mon, stop_dom = inv_doy_mapper[stop_day]
-        expected_datetimes = pd.date_range(start=f'{start_year}-{start_mon:02d}-{start_dom:02d}',
-                                           end=f'{stop_year}-{stop_mon:02d}-{stop_dom:02d}')
+        expected_datetimes = pd.date_range(start=start, end=stop)
         expected_datetimes = expected_datetimes[~((expected_datetimes.month == 2) & (expected_datetimes.day == 29))]
         expected_years = expected_datetimes.year.values
-        expected_days = np.array(
-            [doy_day_mapper[(m, d)] for m, d in zip(expected_datetimes.month, expected_datetimes.day)])
+        expected_days = expected_datetimes.dayofyear.values - (expected_datetimes.is_leap_year &
+                                                               (expected_datetimes.month > 2))
         addmess = ' note that leap days are expected to have been removed from matrix weather'
     else:
-        expected_datetimes = pd.date_range(start=pd.to_datetime('{}-{}'.format(start_year, start_day), format='%Y-%j'),
-                                           end=pd.to_datetime('{}-{}'.format(stop_year, stop_day), format='%Y-%j'))
+        expected_datetimes = pd.date_range(start=start, end=stop)
         expected_years = expected_datetimes.year.values
         expected_days = expected_datetimes.dayofyear.values
         addmess = ''
 
-    check = ((matrix_weather['year'].values == expected_years).all() and
-             (matrix_weather['doy'].values == expected_days).all())
+    check = len(dates) == len(expected_datetimes) and (years == expected_years).all() and (doys == expected_days).all()
     assert check, 'the date range of matrix_weather contains missing or duplicate days' + addmess
+    return expected_datetimes, addmess
+
+
+def _test_days_harvest(days_harvest, run_365_calendar):
+    """
+    check the harvest data (the checks which do not depend on the weather data)
 
-    # check harvest data
+    :param days_harvest: days harvest dataframe
+    :param run_365_calendar: boolean, see run_basgra_nz
+    :return:
+    """
     assert isinstance(days_harvest, pd.DataFrame)
     assert set(days_harvest.keys()) == set(days_harvest_keys), 'incorrect keys for days_harvest'
     assert pd.api.types.is_integer_dtype(days_harvest.doy), 'doy must be an integer datatype in days_harvest'
@@ -211,43 +917,45 @@ def _test_basgra_inputs(params, matrix_weather, days_harvest, verbose, _matrix_w
     assert (days_harvest['frac_harv'] <= 1).all(), 'frac_harv cannot be greater than 1'
     if run_365_calendar:
         assert days_harvest.doy.max() <= 365
-    if params['fixed_removal'] > 0.9:
-        assert (days_harvest['harv_trig'] >=
-                days_harvest['harv_targ']).all(), 'when using fixed harvest mode the harv_trig>=harv_targ'
 
-    if auto_harvest:
-        assert len(matrix_weather) == len(
-            days_harvest), 'days_harvest and matrix_weather must be the same length(ndays)'
 
-        check = (days_harvest['year'].values == matrix_weather.year.values).all() and (
-                days_harvest['doy'].values == matrix_weather.doy.values).all()
-        assert check, 'the date range of days_harvest does not match matrix_weather' + addmess
-    else:
-        if run_365_calendar:
-            mapper = get_month_day_to_nonleap_doy(key_doy=True)
-            strs = [f'{y}-{mapper[doy][0]:02d}-{mapper[doy][1]:02d}' for y, doy in zip(days_harvest.year.values,
-                                                                                       days_harvest.doy.values)]
-            harvest_dt = pd.to_datetime(strs)
-
-        else:
-            strs = ['{}-{:03d}'.format(int(e), int(f)) for e, f in
-                    days_harvest[['year', 'doy']].itertuples(False, None)]
-            harvest_dt = pd.to_datetime(strs, format='%Y-%j')
-        assert harvest_dt.min() >= expected_datetimes.min(), 'days_harvest must start at or after first day of simulation'
-        assert harvest_dt.max() <= expected_datetimes.max(), 'days_harvest must stop at or before last day of simulation'
+def _test_doy_irr(doy_irr):
+    """
+    check the days of year to irrigate on
 
-    # doy_irr tests
+    :param doy_irr: np.ndarray of the days of year to irrigate on
+    :return:
+    """
     assert isinstance(doy_irr, np.ndarray), 'doy_irr must be convertable to a numpy array'
     assert doy_irr.ndim == 1, 'doy_irr must be 1d'
     assert pd.api.types.is_integer_dtype(doy_irr), 'doy_irr must be integers'
     assert doy_irr.max() <= 366, 'entries doy_irr must not be greater than 366'
     assert doy_irr.min() >= 0, 'entries doy_irr must not be less than 0'
 
-    # pass a warning if max_irr is greater than abs_max_irr
-    if matrix_weather.loc[:, 'max_irr'].max() > params['abs_max_irr']:
-        warn(f'maximum weather_matrix max_irr ({matrix_weather.loc[:, "max_irr"].max()}) > absolute maximum '
-             f'irrigation {params["abs_max_irr"]}.  The extra irrigation can never be applied but may be available for '
-             f'storage.')
+
+def year_doy_to_datetime(year, doy, run_365_calendar=False):
+    """
+    vectorised conversion of year and day of year to dates, e.g. to build the date index of basgra outputs once for a
+    batch of runs. This is much faster than formatting and parsing date strings.
+
+    :param year: array like of years (e.g. matrix_weather.year)
+    :param doy: array like of days of year (e.g. matrix_weather.doy)
+    :param run_365_calendar: boolean, if True doy is on a 365 day calendar (1-365, leap days removed) and is mapped to the equivalent month and day (see run_basgra_nz and get_month_day_to_nonleap_doy), if False doy is the standard gregorian day of year (1-366)
+    :return: pd.DatetimeIndex (datetime64[ns])
+    """
+    year = np.atleast_1d(year).astype(np.int64)
+    doy = np.atleast_1d(doy).astype(np.int64)
+    assert year.shape == doy.shape, 'year and doy must be the same shape'
+    is_leap = (year % 4 == 0) & ((year % 100 != 0) | (year % 400 == 0))
+    assert (doy >= 1).all(), 'doy must be >= 1'
+    if run_365_calendar:
+        assert (doy <= 365).all(), 'doy must be <= 365 on a 365 day calendar'
+        offset = doy - 1 + (is_leap & (doy >= 60))  # skip 29 Feb in leap years
+    else:
+        assert (doy <= 365 + is_leap).all(), 'doy must be <= 365 (366 in leap years)'
+        offset = doy - 1
+    dates = (year - 1970).astype('datetime64[Y]').astype('datetime64[D]') + offset.astype('timedelta64[D]')
+    return pd.DatetimeIndex(dates.astype('datetime64[ns]'))
 
 
 def get_month_day_to_nonleap_doy(key_doy=False):
@@ -0,0 +1,72 @@
+"""
+ahead of time compilation of the fortran BASGRA kernel, run before packaging / deploying so that the first call in a
+fresh environment loads the compiled kernel directly rather than compiling it:
+
+    python -m komanawa.basgra_nz_py.build
+"""
+import argparse
+import os
+import shutil
+import tempfile
+from pathlib import Path
+from komanawa.basgra_nz_py.get_fortran_module import build_profiles, _fortran_dir, _get_compile_options, \
+    _get_source_hash, _compile_kernel
+
+
+def build_kernel(binname='gfortran-12', verbose=False, profile='portable'):
+    """
+    compile the fortran kernel into the package, a single kernel serves both the PET and the Penman weather modes
+    (supply_pet is passed at runtime). The compiled wrapper is made relocatable so it can be shipped with the package
+    (e.g. in a wheel or container image) and loaded directly at runtime. The kernel is tagged with the hash of its
+    sources and flags, so it is only used while they match.
+
+    :param binname: str the name of the gfortran compiler to use, only tested on 11.4.0 and 12.3.0
+    :param verbose: bool if True print the fortran compilation output
+    :param profile: str the build profile, see komanawa.basgra_nz_py.get_fortran_module.build_profiles, all profiles
+                    other than 'portable' must reproduce the regression test outputs. Set $BASGRA_NZ_BUILD_PROFILE at
+                    runtime to use a kernel built with a different profile.
+    :return: the compiled module directory
+    """
+    module_name, f_compiler_args = _get_compile_options(profile)
+    kernel_root = _fortran_dir.joinpath(f'compiled_{module_name}')
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f'.compiled_{module_name}-', dir=_fortran_dir))
+    try:
+        _compile_kernel(tmp_dir, f_compiler_args, binname, verbose, profile)
+        _make_relocatable(tmp_dir.joinpath('basgraf', '__init__.py'))
+        kernel_root.joinpath('kernel_hash.txt').unlink(missing_ok=True)
+        shutil.rmtree(kernel_root.joinpath('basgraf'), ignore_errors=True)
+        kernel_root.mkdir(exist_ok=True)
+        os.replace(tmp_dir.joinpath('basgraf'), kernel_root.joinpath('basgraf'))
+        kernel_root.joinpath('kernel_hash.txt').write_text(_get_source_hash(module_name, f_compiler_args))
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return kernel_root.joinpath('basgraf')
+
+
+def _make_relocatable(wrapper_path):
+    """
+    modify the fmodpy generated wrapper so that any fallback compilation (if the shared object is missing) uses the
+    fortran sources relative to the installed package rather than the absolute paths on the build machine.
+
+    :param wrapper_path: Path to the generated basgraf/__init__.py
+    :return:
+    """
+    wrapper_path = Path(wrapper_path)
+    text = wrapper_path.read_text()
+    uncompiled = str(_fortran_dir.joinpath('uncompiled_fortran')) + '/'
+    assert uncompiled in text, f'could not find the fortran source paths in {wrapper_path}'
+    text = text.replace(f"'{uncompiled}", "'../../uncompiled_fortran/")
+    wrapper_path.write_text(text)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='compile the fortran BASGRA kernel ahead of time')
+    parser.add_argument('--binname', default='gfortran-12', help='the name of the gfortran compiler to use')
+    parser.add_argument('--verbose', action='store_true', help='print the fortran compilation output')
+    parser.add_argument('--profile', default='portable', choices=list(build_profiles), help='the build profile')
+    args = parser.parse_args(args)
+    print(f'compiled: {build_kernel(binname=args.binname, verbose=args.verbose, profile=args.profile)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -2,24 +2,373 @@
 created matt_dumont 
 on: 26/04/24
 """
-from copy import deepcopy
+import hashlib
+import importlib.util
+import os
+import platform
+import re
+import shutil
+import tempfile
 import warnings
 import fmodpy
 import sys
+from contextlib import contextmanager
 from pathlib import Path
 import subprocess
 
+try:
+    import fcntl
+except ImportError:  # not posix, compiled kernels are not locked across processes
+    fcntl = None
 
-def get_fortran_basgra(supply_pet, recomplile=False, verbose=False, binname='gfortran-12'):
+_fortran_dir = Path(__file__).parent.joinpath('fortran_BASGRA_NZ')
+_dependencies = [
+    'parameters_plant.f95',
+    'parameters_site.f95',
+    'plant.f95',
+    'resources.f95',
+    'set_params.f95',
+    'soil.f95',
+    'h2o_storage.f95',
+    'environment.f95',
+    'brent.f95',
+]
+
+# the staleness check in the fmodpy generated wrapper, compares the source modification times against the shared object
+# and recompiles (in place) if any source is newer, compiled kernels are keyed by the source hash instead
+_staleness_check = re.compile(
+    r'if \(max\(max\(\[0\]\+.*?> os\.path\.getmtime\(_path_to_lib\)\):\n(\s+)print\(\)\n\s+print\(".*?"', re.DOTALL)
+
+# compiler flags added to the base flags for each build profile, the pgo profile is additionally compiled with
+# -fprofile-generate, trained on the example runs (see _pgo_training) and recompiled with -fprofile-use.
+# fused multiply-add contraction (enabled by -march=native on cpus with fma) changes the irrigation and water
+# shortage regression outputs by more than rtol=1e-4, so it is disabled in all profiles
+build_profiles = {
+    'portable': [],
+    'native': ['-march=native', '-ffp-contract=off'],
+    'fast': ['-march=native', '-ffp-contract=off', '-ffast-math', '-flto'],
+    'pgo': ['-march=native', '-ffp-contract=off', '-flto'],
+}
+
+# per process cache of the imported fortran modules, keyed by (binname, compiler args)
+_fortran_modules = {}
+
+
+def get_fortran_basgra(recomplile=False, verbose=False, binname='gfortran-12', profile=None):
     """
-    get the callable fortran BASGRA function
+    get the callable fortran BASGRA function, a single kernel supports both the PET and the peyman (Penman) weather
+    modes (set at runtime by the supply_pet argument of basgra/basgra_batch). The module is cached for the life of the
+    process so the compiler is only probed (and the module imported) when it is first requested or when it is
+    recompiled.
+
+    The compiled kernels are content addressed by a hash of the fortran sources and the compiler flags. Kernels
+    compiled ahead of time (python -m komanawa.basgra_nz_py.build) are used if their hash matches, otherwise the
+    kernel is compiled (once, see get_kernel_cache_dir) into the user cache directory.  If $BASGRA_NZ_KERNEL_DIR is set
+    the compiled kernel in that directory is used directly.
 
-    :param supply_pet: bool if True use the PET version, if False use the peyman version
     :param recomplile: bool if True force recompile the fortran code
     :param verbose: bool if True print the fortran compilation output
-    :param version: str the version of gfortran to use, only tested on 11.4.0
+    :param binname: str the name of the gfortran compiler to use, only tested on 11.4.0 and 12.3.0
+    :param profile: None or str the build profile (see build_profiles), if None $BASGRA_NZ_BUILD_PROFILE if set
+                    otherwise 'portable'. All profiles other than 'portable' are checked against the regression test
+                    outputs (rtol=1e-4) when compiled and are not used if they fail.
     :return:
     """
+    kernel_dir = os.environ.get('BASGRA_NZ_KERNEL_DIR')
+    if kernel_dir:
+        cache_key = (kernel_dir,)
+    else:
+        profile = profile or os.environ.get('BASGRA_NZ_BUILD_PROFILE') or 'portable'
+        module_name, f_compiler_args = _get_compile_options(profile)
+        cache_key = (binname, tuple(f_compiler_args))
+    if not recomplile and cache_key in _fortran_modules:
+        return _fortran_modules[cache_key]
+
+    if kernel_dir:
+        kernel_dir = Path(kernel_dir)
+    else:
+        source_hash = _get_source_hash(module_name, f_compiler_args)
+        packaged_dir = _fortran_dir.joinpath(f'compiled_{module_name}')
+        if not recomplile and _read_kernel_hash(packaged_dir) == source_hash:
+            kernel_dir = packaged_dir.joinpath('basgraf')
+        else:
+            kernel_dir = _get_cached_kernel(module_name, f_compiler_args, source_hash, binname, recomplile, verbose,
+                                            profile)
+
+    spec = importlib.util.spec_from_file_location(f'_basgraf_{kernel_dir.parent.name}',
+                                                  kernel_dir.joinpath('__init__.py'),
+                                                  submodule_search_locations=[str(kernel_dir)])
+    kernel = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(kernel)
+    basgramodule = kernel.basgramodule
+
+    _fortran_modules[cache_key] = basgramodule
+    return basgramodule
+
+
+def get_kernel_cache_dir():
+    """
+    get the directory for the compiled fortran kernels, $BASGRA_NZ_CACHE_DIR if set, otherwise
+    $XDG_CACHE_HOME/komanawa-basgra-nz-py (default ~/.cache/komanawa-basgra-nz-py)
+
+    :return: Path
+    """
+    if os.environ.get('BASGRA_NZ_CACHE_DIR'):
+        return Path(os.environ['BASGRA_NZ_CACHE_DIR'])
+    cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home().joinpath('.cache')
+    return Path(cache_home).joinpath('komanawa-basgra-nz-py')
+
+
+def _get_compile_options(profile='portable'):
+    """
+    get the module name and compiler flags for the kernel
+
+    :param profile: str the build profile, see build_profiles
+    :return: module_name, f_compiler_args
+    """
+    assert profile in build_profiles, f'unknown build profile {profile}, expected one of {list(build_profiles)}'
+    module_name = 'for_basgra' if profile == 'portable' else f'for_basgra_{profile}'
+    f_compiler_args = ['-x', 'f95-cpp-input', '-O3', '-fdefault-real-8', '-cpp', '-fopenmp'] + build_profiles[profile]
+    return module_name, f_compiler_args
+
+
+def _get_source_hash(module_name, f_compiler_args):
+    """
+    hash of the fortran sources, the compiler flags and the fmodpy version (which generates the wrapper)
+
+    :param module_name: str the name of the kernel
+    :param f_compiler_args: list of compiler flags
+    :return: str hex digest
+    """
+    source_hash = hashlib.sha256()
+    source_hash.update(f'{module_name}|{fmodpy.__version__}|{" ".join(f_compiler_args)}'.encode())
+    for f in _dependencies + ['basgraf.f95']:
+        source_hash.update(f.encode())
+        source_hash.update(_fortran_dir.joinpath('uncompiled_fortran', f).read_bytes())
+    return source_hash.hexdigest()
+
+
+def _get_compiler_fingerprint(binname):
+    """
+    identify the compiler without running it: the resolved path, size and modification time of the compiler binary,
+    which change whenever the compiler is upgraded.
+
+    :param binname: str the name of the gfortran compiler to use
+    :return: str
+    """
+    path = shutil.which(binname) or shutil.which('gfortran')
+    if path is None:
+        return binname
+    path = os.path.realpath(path)
+    stat = os.stat(path)
+    return f'{path}|{stat.st_size}|{stat.st_mtime_ns}'
+
+
+def _get_cpu_fingerprint():
+    """
+    identify the cpu, kernels compiled with -march=native are only valid on the cpu they were compiled on
+
+    :return: str
+    """
+    cpuinfo = Path('/proc/cpuinfo')
+    if not cpuinfo.exists():
+        return platform.processor()
+    info = {}
+    for line in cpuinfo.read_text().splitlines():
+        if not line.strip():
+            break  # the first processor describes them all
+        key, _, value = line.partition(':')
+        info[key.strip()] = value.strip()
+    return f'{info.get("model name")}|{info.get("flags")}'
+
+
+def _read_kernel_hash(kernel_root):
+    """
+    read the source hash of a compiled kernel
+
+    :param kernel_root: Path the directory holding the compiled basgraf module
+    :return: str or None if the kernel has not been compiled
+    """
+    hash_path = Path(kernel_root).joinpath('kernel_hash.txt')
+    if not hash_path.exists() or not Path(kernel_root).joinpath('basgraf', '__init__.py').exists():
+        return None
+    return hash_path.read_text().strip()
+
+
+def _get_cached_kernel(module_name, f_compiler_args, source_hash, binname, recomplile, verbose, profile='portable'):
+    """
+    get the compiled kernel from the user cache, compiling it if needed. The compile is guarded by a file lock and the
+    kernel is compiled into a temporary directory and then moved into place, so concurrent processes compile once and
+    never load a partially written kernel.
+
+    :param module_name: str the name of the kernel
+    :param f_compiler_args: list of compiler flags
+    :param source_hash: str see _get_source_hash
+    :param binname: str the name of the gfortran compiler to use
+    :param recomplile: bool if True force recompile the fortran code
+    :param verbose: bool if True print the fortran compilation output
+    :param profile: str the build profile, see build_profiles
+    :return: Path to the compiled basgraf module
+    """
+    fingerprint = _get_compiler_fingerprint(binname)
+    if '-march=native' in f_compiler_args:
+        fingerprint += _get_cpu_fingerprint()
+    key = hashlib.sha256(f'{source_hash}|{fingerprint}'.encode()).hexdigest()[:16]
+    cache_dir = get_kernel_cache_dir()
+    kernel_root = cache_dir.joinpath(f'{module_name}-{key}')
+    if not recomplile and _read_kernel_hash(kernel_root) == source_hash:
+        return kernel_root.joinpath('basgraf')
+
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    with _file_lock(cache_dir.joinpath(f'{module_name}-{key}.lock')):
+        if not recomplile and _read_kernel_hash(kernel_root) == source_hash:
+            return kernel_root.joinpath('basgraf')  # compiled by another process while waiting for the lock
+
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f'.{module_name}-{key}-', dir=cache_dir))
+        old_dir = tmp_dir.with_name(tmp_dir.name + '-old')
+        try:
+            _compile_kernel(tmp_dir, f_compiler_args, binname, verbose, profile)
+            tmp_dir.joinpath('kernel_hash.txt').write_text(source_hash)
+            if kernel_root.exists():
+                os.replace(kernel_root, old_dir)
+            os.replace(tmp_dir, kernel_root)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(old_dir, ignore_errors=True)
+    return kernel_root.joinpath('basgraf')
+
+
+@contextmanager
+def _file_lock(path):
+    """
+    exclusive lock across processes (no-op where fcntl is not available)
+
+    :param path: Path to the lock file
+    """
+    with open(path, 'a') as f:
+        if fcntl is not None:
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _compile_kernel(output_dir, f_compiler_args, binname, verbose, profile='portable'):
+    """
+    compile the fortran kernel with fmodpy into output_dir/basgraf, the fmodpy source modification time check is
+    replaced with a check that the shared object exists, as kernels are keyed by their source hash. Kernels compiled
+    with any profile other than 'portable' are checked against the regression test outputs.
+
+    :param output_dir: Path
+    :param f_compiler_args: list of compiler flags
+    :param binname: str the name of the gfortran compiler to use
+    :param verbose: bool if True print the fortran compilation output
+    :param profile: str the build profile, see build_profiles
+    :return:
+    """
+    output_dir = Path(output_dir)
+    kernel_dir = output_dir.joinpath('basgraf')
+    binname = _check_compiler(binname)
+    if profile == 'pgo':
+        # the training and final compilations must use the same paths so that the profile data can be matched, the
+        # instrumented kernel is built in a new process as fmodpy imports it and it writes profile data on exit
+        profile_dir = output_dir.joinpath('pgo_profile')
+        gen_args = f_compiler_args + [f'-fprofile-generate={profile_dir}']
+        subprocess.run([sys.executable, '-c', 'from komanawa.basgra_nz_py.get_fortran_module import _fimport; '
+                                              f'_fimport({str(output_dir)!r}, {gen_args!r}, {binname!r}, {verbose!r})'],
+                       check=True)
+        _run_with_kernel(kernel_dir, 'from komanawa.basgra_nz_py.get_fortran_module import _pgo_training; '
+                                    '_pgo_training()')
+        assert profile_dir.exists(), 'no profile data was written by the pgo training runs'
+        shutil.rmtree(kernel_dir)
+        _fimport(output_dir, f_compiler_args + [f'-fprofile-use={profile_dir}', '-fprofile-correction'],
+                 binname, verbose)
+        shutil.rmtree(profile_dir)
+    else:
+        _fimport(output_dir, f_compiler_args, binname, verbose)
+
+    wrapper_path = kernel_dir.joinpath('__init__.py')
+    text, n = _staleness_check.subn(
+        r'if not os.path.exists(_path_to_lib):\n\1print()\n\1print("WARNING: Compiling because the shared object does not exist."',
+        wrapper_path.read_text())
+    assert n == 1, f'could not find the fmodpy staleness check in {wrapper_path}'
+    wrapper_path.write_text(text)
+
+    if profile != 'portable':
+        result = _run_with_kernel(kernel_dir, None, check=False)
+        if result.returncode != 0:
+            raise ValueError(f'the fortran kernel compiled with the {profile} build profile does not reproduce the '
+                             f'regression test outputs (rtol=1e-4) and will not be used:\n'
+                             f'{result.stderr.decode()[-5000:]}')
+
+
+def _fimport(output_dir, f_compiler_args, binname, verbose):
+    """
+    run fmodpy to build the kernel in output_dir/basgraf
+
+    :param output_dir: Path
+    :param f_compiler_args: list of compiler flags
+    :param binname: str the name of the gfortran compiler to use
+    :param verbose: bool if True print the fortran compilation output
+    :return:
+    """
+    fmodpy.fimport(
+        str(_fortran_dir.joinpath('uncompiled_fortran', 'basgraf.f95')),
+        output_dir=str(output_dir),
+        dependencies=[str(_fortran_dir.joinpath('uncompiled_fortran', f)) for f in _dependencies],
+        f_compiler=binname,
+        f_compiler_args=f_compiler_args,
+        verbose=verbose,
+        end_is_named=False,
+        rebuild=True
+    )
+
+
+def _run_with_kernel(kernel_dir, code, check=True):
+    """
+    run python code (or the regression tests if code is None) in a new process using the compiled kernel in kernel_dir
+
+    :param kernel_dir: Path to the compiled basgraf module
+    :param code: None or str python code to run
+    :param check: bool if True raise an error if the process fails
+    :return: subprocess.CompletedProcess
+    """
+    if code is None:
+        args = ['-m', 'unittest', 'komanawa.basgra_nz_py.tests.test_basgra_python']
+    else:
+        args = ['-c', code]
+    env = dict(os.environ, BASGRA_NZ_KERNEL_DIR=str(kernel_dir))
+    return subprocess.run([sys.executable] + args, env=env, check=check, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE)
+
+
+def _pgo_training():
+    """
+    the training runs for the pgo build profile, the bundled Scott and Lincoln example runs (supplied PET) and the
+    peyman example run (Penman)
+
+    :return:
+    """
+    from komanawa.basgra_nz_py.basgra_python import run_basgra_nz
+    from komanawa.basgra_nz_py.example_data import establish_org_input, establish_peyman_input, clean_harvest
+    for site in ['scott', 'lincoln']:
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input(site)
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        run_basgra_nz(params, matrix_weather, days_harvest, doy_irr)
+    params, matrix_weather, days_harvest, doy_irr = establish_peyman_input()
+    days_harvest = clean_harvest(days_harvest, matrix_weather)
+    run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, supply_pet=False)
+
+
+def _check_compiler(binname):
+    """
+    check that the gfortran compiler is available and warn if the version has not been tested
+
+    :param binname: str the name of the gfortran compiler to use
+    :return: binname, the name of the compiler to use (falls back to gfortran if binname is not found)
+    """
     tested_fortran_versions = ['11.4.0', '12.3.0']
     bad_tested_fortran_versions = ['13.2.0']
     test_path = Path(__file__).parent.joinpath('tests', 'test_basgra_python.py')
@@ -46,50 +395,8 @@ def get_fortran_basgra(supply_pet, recomplile=False, verbose=False, binname='gfo
     else:
         warnings.warn(
             'This function is only tested on linux, you will need to have Gfortran installed on your system, and no guarantees are made for other systems.')
-    f_compiler_args = ['-x', 'f95-cpp-input', '-O3', '-fdefault-real-8', '-cpp']
-    if supply_pet:
-        module_name = 'for_basgra_pet'
-        f_compiler_args.append('-Dweathergen')
-    else:
-        module_name = 'for_basgra_peyman'
-
-    fortran_dir = Path(__file__).parent.joinpath('fortran_BASGRA_NZ', 'uncompiled_fortran')
-
-    dependencies = [str(fortran_dir.joinpath(f)) for f in [
-        'parameters_plant.f95',
-        'parameters_site.f95',
-        'plant.f95',
-        'resources.f95',
-        'set_params.f95',
-        'soil.f95',
-        'h2o_storage.f95',
-        'environment.f95',
-        'brent.f95',
-    ]]
-
-    basepath = fortran_dir.joinpath('basgraf.f95')
-    outputdir = fortran_dir.parent.joinpath(f'compiled_{module_name}')
-    if outputdir.joinpath('basgraf', '__init__.py').exists() and not recomplile:
-        pass
-    else:
-        for_basgra = fmodpy.fimport(
-            str(basepath),
-            output_dir=str(outputdir),
-            dependencies=dependencies,
-            f_compiler=binname,
-            f_compiler_args=f_compiler_args,
-            verbose=verbose,
-            end_is_named=False,
-            rebuild=True
-        )
-    if supply_pet:
-        from komanawa.basgra_nz_py.fortran_BASGRA_NZ.compiled_for_basgra_pet.basgraf import basgramodule
-    else:
-        from komanawa.basgra_nz_py.fortran_BASGRA_NZ.compiled_for_basgra_peyman.basgraf import basgramodule
-
-    return deepcopy(basgramodule)
+    return binname
 
 
 if __name__ == '__main__':
-    get_fortran_basgra(False)
-    get_fortran_basgra(True)
+    get_fortran_basgra()
@@ -352,6 +352,44 @@ out_cols = (
 
 )
 
+state_keys = (
+    # the model state at the end of a run (see run_basgra_nz return_state), order must match STATE_OUT in basgraf.f95
+    # varname, # description, # units
+    'AGE',  # Days since the start of the simulation, #  (d)
+    'CLV',  # Leaf C, #  (gC m-2)
+    'CLVD',  # Dead Leaf C, #  (gC m-2)
+    'CRES',  # Reserve C, #  (gC m-2)
+    'CRT',  # Root C, #  (gC m-2)
+    'CST',  # Stem C, #  (gC m-2)
+    'CSTUB',  # Stubble C, #  (gC m-2)
+    'DRYSTOR',  # Dry snow storage, #  (mm)
+    'Fdepth',  # Frost depth, #  (m)
+    'LAI',  # Leaf area index, #  (m2 m-2)
+    'LT50',  # Frost tolerance (lethal temperature), #  (degC)
+    'O2',  # Soil oxygen, #  (mol m-2)
+    'PHEN',  # Phenological stage, #  (-)
+    'Sdepth',  # Snow depth, #  (m)
+    'TANAER',  # Time of anaerobic conditions, #  (d)
+    'TILV',  # Vegetative tillers, #  (m-2)
+    'TILG1',  # Generative tillers (not elongating), #  (m-2)
+    'TILG2',  # Generative tillers (elongating), #  (m-2)
+    'BASAL',  # Basal area, #  (fraction)
+    'ROOTD',  # Root depth, #  (m)
+    'VERND',  # Vern. Days, #  (d)
+    'VERN',  # Vernalisation degree, #  (fraction)
+    'WAL',  # Soil water amount liquid, #  (mm)
+    'WALS',  # Rapid surface soil water pool, #  (mm)
+    'WAPL',  # Surface pool water liquid, #  (mm)
+    'WAPS',  # Surface pool water solid (ice), #  (mm)
+    'WAS',  # Soil water solid (ice), #  (mm)
+    'WETSTOR',  # Wet snow storage, #  (mm)
+    'YIELD_RYE',  # Ryegrass yield since 1 June, #  (tDM ha-1)
+    'YIELD_WEED',  # Weed yield since 1 June, #  (tDM ha-1)
+    'DAYL',  # Day length on the last day, #  (d d-1)
+    'h2o_store_vol',  # Storage volume, #  (m3)
+    'harv_delay_remaining',  # Days of the post reseed harvest delay remaining, #  (d)
+)
+
 site_param_keys = (
     'LAT',  # LAT,  # degN, # Latitude
     'WCI',  # WCI,  # m3 m-3, # Initial value of volumetric water content
@@ -0,0 +1,190 @@
+"""
+a process pool for large ensembles of BASGRA runs, the inputs are published once in shared memory and each worker
+writes its results straight into a shared output array, so no data frames are pickled to or from the workers, e.g.:
+
+    with BasgraPool(n_processes=8) as pool:
+        out = pool.run(all_params, matrix_weather, days_harvest, doy_irr)
+"""
+import os
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+from komanawa.basgra_nz_py.basgra_python import _get_validated_inputs, _batch_params_to_array, _test_batch_params, \
+    _get_out_idx, _get_agg_periods, _agg_stats, _get_batch_out_array, _get_batch_fortran_view
+from komanawa.basgra_nz_py.get_fortran_module import get_fortran_basgra
+
+# worker process state: the compiler name and the shared memory blocks of the current ensemble
+_worker = {'binname': 'gfortran-12', 'blocks': {}}
+
+
+class BasgraPool(object):
+    """
+    a pool of worker processes which each keep the compiled fortran kernel loaded between ensembles. Each call to run
+    publishes the validated weather, harvest and irrigation data, the parameters and the output array once in shared
+    memory, the workers then run contiguous chunks of the ensemble (with basgra_batch) directly on the shared arrays.
+    Only the names and shapes of the shared arrays and the chunk bounds are sent to the workers.
+
+    Within one machine run_basgra_nz_batch(n_threads=...) is usually as fast, the pool is useful where OpenMP is not
+    available or where the runs should be isolated in separate processes.
+    """
+
+    def __init__(self, n_processes=None, binname='gfortran-12', mp_context='spawn'):
+        """
+
+        :param n_processes: int or None, the number of worker processes, None uses all available cores (os.cpu_count())
+        :param binname: str, the name of the gfortran compiler to use, default 'gfortran-12'
+        :param mp_context: str the multiprocessing start method, default 'spawn' (forking a process which has already
+                           run the OpenMP batch runner is not safe)
+        """
+        if n_processes is None:
+            n_processes = os.cpu_count()
+        assert isinstance(n_processes, int) and n_processes >= 1, 'n_processes must be None or an integer >= 1'
+        get_fortran_basgra(binname=binname)  # compile (if needed) once before the workers start
+        self.n_processes = n_processes
+        self.binname = binname
+        self._executor = ProcessPoolExecutor(n_processes, mp_context=multiprocessing.get_context(mp_context),
+                                             initializer=_init_worker, initargs=(binname,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        """
+        shut down the worker processes
+
+        :return:
+        """
+        self._executor.shutdown()
+
+    def run(self, params, matrix_weather, days_harvest=None, doy_irr=None, verbose=False, supply_pet=True,
+            auto_harvest=False, run_365_calendar=False, out_vars=None, aggregate=None, record_layout=False,
+            chunksize=None):
+        """
+        run an ensemble of parameter sets which share the same weather, harvest and irrigation data across the worker
+        processes, see run_basgra_nz_batch for the parameters.
+
+        :param chunksize: None or int, the number of runs per task, if None the runs are split evenly across the
+                          workers (4 tasks per worker)
+        :return: np.ndarray, see run_basgra_nz_batch
+        """
+        assert isinstance(verbose, bool), 'verbose must be boolean'
+        inputs = _get_validated_inputs(matrix_weather, days_harvest, doy_irr, supply_pet, auto_harvest,
+                                       run_365_calendar)
+        params = _batch_params_to_array(params)
+        _test_batch_params(params, inputs)
+
+        out_vars, out_idx = _get_out_idx(out_vars)
+        nout = len(out_vars)
+        ndays = len(inputs.dates)
+        nruns = len(params)
+        if aggregate is None:
+            nrows, nstat = ndays, 1
+            period = np.arange(1, ndays + 1, dtype=np.int32)
+        else:
+            period, period_starts = _get_agg_periods(inputs.dates, aggregate)
+            nrows, nstat = len(period_starts), len(_agg_stats)
+        if chunksize is None:
+            chunksize = max(1, -(-nruns // (self.n_processes * 4)))
+        assert isinstance(chunksize, int) and chunksize >= 1, 'chunksize must be None or an integer >= 1'
+
+        arrays = {
+            'params': np.asfortranarray(params.T),
+            'matrix_weather': inputs.matrix_weather,
+            'harvest_day': inputs.days_harvest[0],
+            'harvest_events': inputs.days_harvest[1],
+            'doy_irr': inputs.doy_irr,
+            'penman_terms': inputs.get_penman_terms(self.binname),  # calculated once for the whole ensemble
+            'out_idx': out_idx,
+            'period': period,
+            # the (nrows * nout * nstat, nruns) fortran view of the output, see _get_batch_fortran_view
+            'y': _get_batch_fortran_view(_get_batch_out_array(nruns, nrows, nout, nstat, record_layout)),
+        }
+        blocks = {}
+        try:
+            specs = {}
+            for name, array in arrays.items():
+                block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+                blocks[name] = block
+                np.ndarray(array.shape, array.dtype, buffer=block.buf, order='F')[...] = array
+                specs[name] = (block.name, array.shape, array.dtype.str)
+
+            tasks = [self._executor.submit(_run_chunk, specs, start, min(start + chunksize, nruns), inputs.supply_pet,
+                                           record_layout, nout, nstat, verbose)
+                     for start in range(0, nruns, chunksize)]
+            for task in tasks:
+                task.result()
+            y = np.ndarray(arrays['y'].shape, float, buffer=blocks['y'].buf, order='F').copy(order='F')
+        finally:
+            for block in blocks.values():
+                block.close()
+                block.unlink()
+
+        # -> (nruns, nrows, nout, nstat), as run_basgra_nz_batch
+        if record_layout:
+            y = y.T.reshape((nruns, nrows, nout, nstat))
+        else:
+            y = np.moveaxis(y.reshape((nrows, nout, nstat, nruns), order='F'), -1, 0)
+        if aggregate is None:
+            y = y[..., 0]
+        return y
+
+
+def _init_worker(binname):
+    """
+    load the fortran kernel once in each worker process
+
+    :param binname: str, the name of the gfortran compiler
+    :return:
+    """
+    _worker['binname'] = binname
+    get_fortran_basgra(binname=binname)
+
+
+def _get_shared_arrays(specs):
+    """
+    attach to the shared arrays of an ensemble, the blocks are kept open until the next ensemble
+
+    :param specs: dict name: (shared memory name, shape, dtype)
+    :return: dict name: np.ndarray (F ordered views of the shared memory)
+    """
+    blocks = _worker['blocks']
+    shm_names = {spec[0] for spec in specs.values()}
+    for shm_name in set(blocks) - shm_names:
+        blocks.pop(shm_name).close()
+    arrays = {}
+    for name, (shm_name, shape, dtype) in specs.items():
+        if shm_name not in blocks:
+            blocks[shm_name] = shared_memory.SharedMemory(name=shm_name)
+        arrays[name] = np.ndarray(shape, dtype, buffer=blocks[shm_name].buf, order='F')
+    return arrays
+
+
+def _run_chunk(specs, start, stop, supply_pet, record_layout, nout, nstat, verbose):
+    """
+    run the ensemble members start to stop (exclusive) and write the results into the shared output array
+
+    :param specs: dict name: (shared memory name, shape, dtype), see _get_shared_arrays
+    :param start: int the first run
+    :param stop: int the last run (exclusive)
+    :param supply_pet: boolean, see run_basgra_nz
+    :param record_layout: boolean, see run_basgra_nz_arrays
+    :param nout: int the number of output variables
+    :param nstat: int the number of statistics
+    :param verbose: boolean, see run_basgra_nz
+    :return:
+    """
+    arrays = _get_shared_arrays(specs)
+    fortran_basgra = get_fortran_basgra(binname=_worker['binname'])
+    nrows = arrays['y'].shape[0] // (nout * nstat)
+    matrix_weather = arrays['matrix_weather']
+    # contiguous runs of F ordered arrays are F contiguous views, so fortran writes straight into shared memory
+    fortran_basgra.basgra_batch(arrays['params'][:, start:stop], matrix_weather, len(arrays['harvest_day']),
+                                arrays['harvest_day'], arrays['harvest_events'], matrix_weather.shape[0],
+                                matrix_weather.shape[1], nout, len(arrays['doy_irr']), arrays['doy_irr'],
+                                arrays['out_idx'], nrows, nstat, arrays['period'], arrays['penman_terms'].shape[1],
+                                arrays['penman_terms'], supply_pet, stop - start, 1,
+                                record_layout, verbose, y=arrays['y'][:, start:stop])
@@ -0,0 +1,208 @@
+"""
+an opt-in, persistent (on disk) cache of run_basgra_nz results, for jobs (e.g. calibration or dashboards) which
+request the same runs many times across processes and sessions, e.g.:
+
+    cache = ResultCache()
+    out = cache.run_basgra_nz(params, matrix_weather, days_harvest, doy_irr)
+"""
+import hashlib
+import os
+import tempfile
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from komanawa.basgra_nz_py.input_output_keys import param_keys, state_keys
+from komanawa.basgra_nz_py.basgra_python import run_basgra_nz, ValidatedInputs, _get_validated_inputs, \
+    _test_params, _get_out_idx, _get_state_array, _agg_stats
+from komanawa.basgra_nz_py.get_fortran_module import get_kernel_cache_dir, _get_compile_options, \
+    _get_source_hash, _file_lock
+
+
+class ResultCache(object):
+    """
+    a persistent cache of run_basgra_nz results keyed by a hash of all of the inputs and of the fortran kernel build
+    (sources, compiler flags and compiler). Each result is stored as a numpy (.npz) file holding the output array in
+    column major order, which is read back in a few milliseconds. The cache is limited by its total size, the least recently used results are
+    evicted first. Results are written atomically and eviction is guarded by a file lock, so the cache can be shared
+    by concurrent processes.
+    """
+
+    def __init__(self, cache_dir=None, max_size_mb=1024):
+        """
+
+        :param cache_dir: None or path to the cache directory, if None get_kernel_cache_dir()/results
+        :param max_size_mb: float, the maximum total size of the cached results (MB)
+        """
+        assert max_size_mb > 0, 'max_size_mb must be > 0'
+        if cache_dir is None:
+            cache_dir = get_kernel_cache_dir().joinpath('results')
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size = int(max_size_mb * 1024 ** 2)
+
+    def run_basgra_nz(self, params, matrix_weather, days_harvest=None, doy_irr=None, verbose=False, supply_pet=True,
+                      auto_harvest=False, run_365_calendar=False, binname='gfortran-12', out_vars=None,
+                      aggregate=None, state=None, return_state=False):
+        """
+        run_basgra_nz, but return the cached result if the same run has already been made, see run_basgra_nz for the
+        parameters.
+
+        :return: see run_basgra_nz
+        """
+        assert isinstance(return_state, bool), 'return_state must be boolean'
+        _test_params(params)
+        out_vars, _ = _get_out_idx(out_vars)
+        if state is not None:
+            state = _get_state_array(state)
+
+        # the inputs are only validated if the run is not cached, as the validation is slower than reading the result
+        key = _get_result_key(params, matrix_weather, days_harvest, doy_irr, supply_pet, auto_harvest,
+                              run_365_calendar, out_vars, aggregate, state, binname)
+        path = self.cache_dir.joinpath(f'{key}.npz')
+        try:
+            with np.load(path) as data:
+                values, index, state_out = data['values'], data['index'], data['state']
+            os.utime(path)  # mark as recently used
+        except (FileNotFoundError, OSError, KeyError, ValueError):  # missing, evicted or incomplete
+            inputs = _get_validated_inputs(matrix_weather, days_harvest, doy_irr, supply_pet, auto_harvest,
+                                           run_365_calendar)
+            out, state_out = run_basgra_nz(params, inputs, verbose=verbose, binname=binname, out_vars=out_vars,
+                                           aggregate=aggregate, state=state, return_state=True)
+            values, index, state_out = out.values, out.index.values, state_out.values
+            self._write(path, values=values, index=index, state=state_out)
+            self._evict()
+
+        if aggregate is None:
+            out = pd.DataFrame(values, pd.Index(index, name='date'), out_vars)
+        else:
+            out = pd.DataFrame(values, pd.Index(index, name='period_start'),
+                               pd.MultiIndex.from_product([out_vars, _agg_stats]))
+        if return_state:
+            return out, pd.Series(state_out, index=list(state_keys), name='state')
+        return out
+
+    def size(self):
+        """
+        the total size of the cached results
+
+        :return: int (bytes)
+        """
+        return sum(size for _, size, _ in self._list())
+
+    def clear(self):
+        """
+        remove all of the cached results
+
+        :return:
+        """
+        with _file_lock(self.cache_dir.joinpath('.lock')):
+            for path, _, _ in self._list():
+                path.unlink(missing_ok=True)
+
+    def _write(self, path, **arrays):
+        """
+        write a result atomically so that concurrent readers never see a partial file
+
+        :param path: Path of the result
+        :param arrays: the arrays to store
+        :return:
+        """
+        fd, tmp_path = tempfile.mkstemp(prefix='.tmp-', suffix='.npz', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, **{k: np.asfortranarray(v) for k, v in arrays.items()})
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    def _list(self):
+        """
+        list the cached results
+
+        :return: list of (path, size, last used time)
+        """
+        out = []
+        for path in self.cache_dir.glob('*.npz'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:  # evicted by another process
+                continue
+            out.append((path, stat.st_size, stat.st_mtime))
+        return out
+
+    def _evict(self):
+        """
+        remove the least recently used results until the cache is within max_size
+
+        :return:
+        """
+        results = self._list()
+        total = sum(size for _, size, _ in results)
+        if total <= self.max_size:
+            return
+        with _file_lock(self.cache_dir.joinpath('.lock')):
+            results = sorted(self._list(), key=lambda e: e[2])
+            total = sum(size for _, size, _ in results)
+            for path, size, _ in results:
+                if total <= self.max_size:
+                    break
+                path.unlink(missing_ok=True)
+                total -= size
+
+
+# the kernel source hash of each build profile, hashing the fortran sources on every call would be slow
+_kernel_ids = {}
+
+
+def _get_kernel_id():
+    """
+    identify the fortran kernel which is used by run_basgra_nz (see get_fortran_basgra)
+
+    :return: str
+    """
+    kernel_dir = os.environ.get('BASGRA_NZ_KERNEL_DIR')
+    if kernel_dir:
+        return str(Path(kernel_dir).resolve())
+    profile = os.environ.get('BASGRA_NZ_BUILD_PROFILE') or 'portable'
+    if profile not in _kernel_ids:
+        _kernel_ids[profile] = _get_source_hash(*_get_compile_options(profile))
+    return _kernel_ids[profile]
+
+
+def _get_result_key(params, matrix_weather, days_harvest, doy_irr, supply_pet, auto_harvest, run_365_calendar,
+                    out_vars, aggregate, state, binname):
+    """
+    get the cache key of a run, a hash of all of the inputs and of the kernel build
+
+    :param params: dictionary of parameters
+    :param matrix_weather: pandas dataframe of weather data or ValidatedInputs, see run_basgra_nz
+    :param days_harvest: days harvest dataframe or None, see run_basgra_nz
+    :param doy_irr: the days of year to irrigate on or None, see run_basgra_nz
+    :param supply_pet: boolean, see run_basgra_nz
+    :param auto_harvest: boolean, see run_basgra_nz
+    :param run_365_calendar: boolean, see run_basgra_nz
+    :param out_vars: list of output variables
+    :param aggregate: see run_basgra_nz
+    :param state: None or np.ndarray of the initial state
+    :param binname: str the name of the gfortran compiler
+    :return: str the sha256 hex digest
+    """
+    hasher = hashlib.sha256()
+    hasher.update(f'{_get_kernel_id()}|{binname}'.encode())
+    hasher.update(np.array([params[k] for k in param_keys], dtype=float).tobytes())
+    if isinstance(matrix_weather, ValidatedInputs):
+        arrays = (matrix_weather.matrix_weather, *matrix_weather.days_harvest, matrix_weather.doy_irr)
+        flags = ('validated', matrix_weather.supply_pet, matrix_weather.run_365_calendar)
+    else:
+        arrays = tuple(pd.util.hash_pandas_object(df.loc[:, sorted(df.columns)]).values
+                       for df in (matrix_weather, days_harvest)) + (np.atleast_1d(doy_irr),)
+        flags = (sorted(matrix_weather.columns), sorted(days_harvest.columns), supply_pet, auto_harvest,
+                 run_365_calendar)
+    for array in arrays:
+        hasher.update(f'{array.shape}{array.dtype}'.encode())
+        hasher.update(np.ascontiguousarray(array).tobytes())
+    if state is not None:
+        hasher.update(state.tobytes())
+    hasher.update(repr(flags + (list(out_vars), aggregate, state is None)).encode())
+    return hasher.hexdigest()
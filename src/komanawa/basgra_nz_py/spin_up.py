@@ -0,0 +1,157 @@
+"""
+a cache of the model state at the end of a spin up period, so that many scenarios which share the same spin up only
+simulate it once, e.g.:
+
+    state = get_spin_up_state(params, spin_up_weather, spin_up_harvest, doy_irr)
+    out = run_basgra_nz(scenario_params, weather, days_harvest, doy_irr, state=state)
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+import numpy as np
+from warnings import warn
+from komanawa.basgra_nz_py.input_output_keys import param_keys, state_keys
+from komanawa.basgra_nz_py.basgra_python import run_basgra_nz, _get_validated_inputs, _test_params
+
+# state variables which never reach a steady state, they are ignored when checking the spin up for convergence
+_non_converging_state_keys = ('AGE',)
+
+
+class SpinUpCache(object):
+    """
+    a bounded, least recently used cache of spin up model states. The states are keyed by a hash of the parameters,
+    the (packed) spin up weather, harvest and irrigation data and the spin up options, so a cached state is only used
+    for an identical spin up. The cache is thread safe.
+    """
+
+    def __init__(self, maxsize=32):
+        """
+
+        :param maxsize: int, the maximum number of states to keep, the least recently used state is evicted first
+        """
+        assert isinstance(maxsize, int) and maxsize >= 1, 'maxsize must be an integer >= 1'
+        self.maxsize = maxsize
+        self._states = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._states)
+
+    def clear(self):
+        """
+        remove all of the cached states
+
+        :return:
+        """
+        with self._lock:
+            self._states.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def get_state(self, params, matrix_weather, days_harvest=None, doy_irr=None, supply_pet=True, auto_harvest=False,
+                  run_365_calendar=False, max_cycles=1, converge_rtol=None, converge_atol=1e-6, verbose=False):
+        """
+        get the model state at the end of the spin up, the spin up is only run if the state is not already cached
+
+        :param params: dictionary, see run_basgra_nz, the parameters used for the spin up
+        :param matrix_weather: pandas dataframe of the spin up weather data (or a ValidatedInputs object), see run_basgra_nz
+        :param days_harvest: days harvest dataframe for the spin up, see run_basgra_nz
+        :param doy_irr: a list of the days of year to irrigate on, see run_basgra_nz
+        :param supply_pet: boolean, see run_basgra_nz
+        :param auto_harvest: boolean, see run_basgra_nz
+        :param run_365_calendar: boolean, see run_basgra_nz
+        :param max_cycles: int, the maximum number of times to repeat the spin up weather, each cycle starts from the state at the end of the previous cycle. The spin up weather should then cover whole years.
+        :param converge_rtol: None or float, if not None stop repeating the spin up once no state variable (other than AGE) changes by more than converge_rtol (relative) or converge_atol (absolute) between consecutive cycles. A warning is raised if the state has not converged after max_cycles.
+        :param converge_atol: float, see converge_rtol
+        :param verbose: boolean, see run_basgra_nz
+        :return: pd.Series(index=state_keys), the model state at the end of the spin up, pass to run_basgra_nz(state=...)
+        """
+        assert isinstance(max_cycles, int) and max_cycles >= 1, 'max_cycles must be an integer >= 1'
+        inputs = _get_validated_inputs(matrix_weather, days_harvest, doy_irr, supply_pet, auto_harvest,
+                                       run_365_calendar)
+        _test_params(params)
+        key = _get_spin_up_key(params, inputs, max_cycles, converge_rtol, converge_atol)
+
+        with self._lock:
+            state = self._states.get(key)
+            if state is not None:
+                self._states.move_to_end(key)
+                self.hits += 1
+                return state.copy()
+            self.misses += 1
+
+        state = _run_spin_up(params, inputs, max_cycles, converge_rtol, converge_atol, verbose)
+        with self._lock:
+            self._states[key] = state
+            self._states.move_to_end(key)
+            while len(self._states) > self.maxsize:
+                self._states.popitem(last=False)
+        return state.copy()
+
+
+def _get_spin_up_key(params, inputs, max_cycles, converge_rtol, converge_atol):
+    """
+    get the cache key of a spin up
+
+    :param params: dictionary of parameters
+    :param inputs: ValidatedInputs
+    :param max_cycles: see SpinUpCache.get_state
+    :param converge_rtol: see SpinUpCache.get_state
+    :param converge_atol: see SpinUpCache.get_state
+    :return: str the sha256 hex digest
+    """
+    hasher = hashlib.sha256()
+    hasher.update(np.array([params[k] for k in param_keys], dtype=float).tobytes())
+    for array in (inputs.matrix_weather, *inputs.days_harvest, inputs.doy_irr):
+        hasher.update(str(array.shape).encode())
+        hasher.update(np.ascontiguousarray(array).tobytes())
+    hasher.update(repr((inputs.supply_pet, inputs.run_365_calendar, max_cycles, converge_rtol,
+                        converge_atol)).encode())
+    return hasher.hexdigest()
+
+
+def _run_spin_up(params, inputs, max_cycles, converge_rtol, converge_atol, verbose):
+    """
+    run the spin up
+
+    :param params: dictionary of parameters
+    :param inputs: ValidatedInputs
+    :param max_cycles: see SpinUpCache.get_state
+    :param converge_rtol: see SpinUpCache.get_state
+    :param converge_atol: see SpinUpCache.get_state
+    :param verbose: boolean, see run_basgra_nz
+    :return: pd.Series(index=state_keys)
+    """
+    check = ~np.isin(state_keys, _non_converging_state_keys)
+    state = None
+    for cycle in range(max_cycles):
+        # only the state is needed, so store the minimum of output
+        _, new_state = run_basgra_nz(params, inputs, verbose=verbose, out_vars=['BASAL'], state=state,
+                                     return_state=True)
+        if converge_rtol is not None and state is not None and np.allclose(
+                new_state.values[check], state.values[check], rtol=converge_rtol, atol=converge_atol):
+            return new_state
+        state = new_state
+    if converge_rtol is not None and max_cycles > 1:
+        warn(f'the spin up state did not converge within max_cycles ({max_cycles}) cycles')
+    return state
+
+
+# the default cache used by get_spin_up_state
+spin_up_cache = SpinUpCache()
+
+
+def get_spin_up_state(params, matrix_weather, days_harvest=None, doy_irr=None, supply_pet=True, auto_harvest=False,
+                      run_365_calendar=False, max_cycles=1, converge_rtol=None, converge_atol=1e-6, verbose=False):
+    """
+    get the model state at the end of the spin up using the default (process wide) spin up cache (spin_up_cache), see
+    SpinUpCache.get_state for the parameters.
+
+    :return: pd.Series(index=state_keys), the model state at the end of the spin up, pass to run_basgra_nz(state=...)
+    """
+    return spin_up_cache.get_state(params, matrix_weather, days_harvest, doy_irr, supply_pet=supply_pet,
+                                   auto_harvest=auto_harvest, run_365_calendar=run_365_calendar,
+                                   max_cycles=max_cycles, converge_rtol=converge_rtol, converge_atol=converge_atol,
+                                   verbose=verbose)
@@ -7,8 +7,10 @@ import unittest
 
 import pandas as pd
 import numpy as np
-from komanawa.basgra_nz_py.basgra_python import run_basgra_nz, _trans_manual_harv, get_month_day_to_nonleap_doy
-from komanawa.basgra_nz_py.input_output_keys import matrix_weather_keys_pet
+from komanawa.basgra_nz_py.basgra_python import run_basgra_nz, run_basgra_nz_batch, run_basgra_nz_arrays, \
+    year_doy_to_datetime, ValidatedInputs, BasgraSimulation, get_penman_terms, _trans_manual_harv, _get_agg_periods, \
+    get_month_day_to_nonleap_doy, _get_harvest_events
+from komanawa.basgra_nz_py.input_output_keys import matrix_weather_keys_pet, out_cols, param_keys, days_harvest_keys
 from komanawa.basgra_nz_py.example_data import establish_org_input, clean_harvest, example_data_dir, get_lincoln_broadfield, get_org_correct_values, base_manual_harvest_data, base_auto_harvest_data, establish_peyman_input, get_input_for_storage_tests
 
 verbose = False
@@ -76,6 +78,36 @@ class TestBasgraPython(unittest.TestCase):
         correct_out = pd.read_csv(data_path, index_col=0)
         self._output_checks(out, correct_out, dropable=False)
 
+    def test_trans_manual_harv_fill(self):
+        matrix_weather = pd.DataFrame({'year': 2000, 'doy': np.arange(1, 11)})
+        days_harvest = pd.DataFrame({'year': 2000, 'doy': [3, 6, 6], 'frac_harv': [1., 0.5, 0.25],
+                                     'harv_trig': [2., 3., 4.], 'harv_targ': [1., 1., 1.],
+                                     'weed_dm_frac': [0.1, 0.2, 0.3], 'reseed_trig': [-1., -1., 0.5],
+                                     'reseed_basal': [0., 0., 0.2]})
+        days_harvest = days_harvest.loc[:, days_harvest_keys]
+
+        # the first day has no weed_dm_frac, so it is filled from the first event with a warning
+        with self.assertWarns(UserWarning):
+            out = _trans_manual_harv(days_harvest, matrix_weather)
+        self.assertEqual(len(out), 10)
+        self.assertTrue(np.allclose(out.weed_dm_frac, [0.1] * 5 + [0.3] * 5))
+
+        # days without an event are not harvested or reseeded, duplicate days take the last event
+        self.assertTrue(np.allclose(out.harv_trig, [-1, -1, 2, -1, -1, 4, -1, -1, -1, -1]))
+        self.assertTrue(np.allclose(out.frac_harv, [0, 0, 1, 0, 0, 0.25, 0, 0, 0, 0]))
+        self.assertTrue(np.allclose(out.reseed_trig, [-1] * 5 + [0.5] + [-1] * 4))
+
+        # the sparse events give the same (last) event for the duplicate day
+        harvest_day, harvest_events = _get_harvest_events(days_harvest, matrix_weather.values, False)
+        self.assertTrue(np.array_equal(harvest_day, [3, 6, 6]))
+        self.assertTrue(np.allclose(harvest_events[-1], out.iloc[5, 2:].values))
+
+        # days which are not in the weather data are rejected
+        bad = days_harvest.copy()
+        bad.loc[0, 'doy'] = 11
+        with self.assertRaises(AssertionError):
+            _trans_manual_harv(bad, matrix_weather)
+
     def _export_for_visual_debugging(self, out, correct_out, test_nm, r=2):
         out.round(r).to_csv(os.path.join(os.path.dirname(example_data_dir), f'{test_nm}_out.csv'), sep='\t')
         correct_out.round(r).to_csv(os.path.join(os.path.dirname(example_data_dir), f'{test_nm}_correct_out.csv'), sep='\t')
@@ -303,6 +335,33 @@ class TestBasgraPython(unittest.TestCase):
         correct_out = pd.read_csv(data_path, index_col=0)
         self._output_checks(out, correct_out)
 
+    def test_penman_terms(self):
+        params, matrix_weather, days_harvest, doy_irr = establish_peyman_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        inputs = ValidatedInputs(matrix_weather, days_harvest, doy_irr, supply_pet=False)
+
+        # the weather only terms are calculated once per weather series
+        penman_terms = inputs.get_penman_terms()
+        self.assertEqual(penman_terms.shape, (len(matrix_weather), 3))
+        self.assertFalse(penman_terms.flags.writeable)
+        self.assertIs(inputs.get_penman_terms(), penman_terms)
+        self.assertEqual(get_penman_terms(inputs.matrix_weather, supply_pet=True).shape, (len(matrix_weather), 0))
+
+        p = np.array([params[k] for k in param_keys], dtype=float)
+        out = run_basgra_nz_arrays(p, inputs.matrix_weather, inputs.days_harvest, inputs.doy_irr, supply_pet=False,
+                                   verbose=verbose)
+        shared_out = run_basgra_nz_arrays(p, inputs.matrix_weather, inputs.days_harvest, inputs.doy_irr,
+                                          supply_pet=False, verbose=verbose, penman_terms=penman_terms)
+        self.assertTrue(np.array_equal(out, shared_out, equal_nan=True))
+
+        # the day length depends on the latitude of each run
+        all_params = [{**params, 'LAT': lat} for lat in [-35, -46]]
+        batch_out = run_basgra_nz_batch(all_params, inputs, verbose=verbose)
+        for i, p in enumerate(all_params):
+            correct_out = run_basgra_nz(p, matrix_weather, days_harvest, doy_irr, verbose=verbose, supply_pet=False)
+            self.assertTrue(np.array_equal(batch_out[i], correct_out.values, equal_nan=True))
+        self.assertFalse(np.array_equal(batch_out[0], batch_out[1], equal_nan=True))
+
     # Manual Harvest tests
 
     def test_fixed_harvest_man(self, update_data=False):
@@ -1086,6 +1145,560 @@ class TestBasgraPython(unittest.TestCase):
         correct_out = pd.read_csv(data_path, index_col=0)
         self._output_checks(out, correct_out)
 
+    def test_batch(self):
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input('lincoln')
+
+        matrix_weather = get_lincoln_broadfield()
+        matrix_weather.loc[:, 'max_irr'] = 1
+        matrix_weather.loc[matrix_weather.index > '2015-08-01', 'max_irr'] = 15
+        matrix_weather.loc[:, 'irr_trig'] = 0.5
+        matrix_weather.loc[:, 'irr_targ'] = 1
+        matrix_weather = matrix_weather.loc[:, matrix_weather_keys_pet]
+        doy_irr = list(range(305, 367)) + list(range(1, 91))
+
+        # reseed so that the harvest delay is exercised, it must not leak between runs
+        days_harvest.loc[:, 'reseed_trig'] = 0.75
+        days_harvest.loc[:, 'reseed_basal'] = 0.88
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+
+        params['IRRIGF'] = .90
+        params['reseed_harv_delay'] = 120
+        params2 = params.copy()
+        params2['IRRIGF'] = .5
+        params2['reseed_harv_delay'] = 10
+        params3 = params.copy()
+        params3['LAT'] = -45
+        all_params = [params, params2, params3, params]
+
+        out = run_basgra_nz_batch(all_params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+        self.assertEqual(out.shape, (len(all_params), len(matrix_weather), len(out_cols)))
+        self.assertTrue(out[0, :, out_cols.index('RESEEDED')].sum() > 0, 'test should include a reseed')
+
+        for i, p in enumerate(all_params):
+            correct_out = run_basgra_nz(p, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+            batch_out = pd.DataFrame(out[i], index=correct_out.index, columns=out_cols)
+            self._output_checks(batch_out, correct_out)
+
+        # the other parameter formats should give identical results
+        out2 = run_basgra_nz_batch(pd.DataFrame(all_params), matrix_weather, days_harvest, doy_irr, verbose=verbose)
+        self.assertTrue(np.array_equal(out, out2, equal_nan=True))
+
+        # splitting the runs across OpenMP threads must not change the results
+        out3 = run_basgra_nz_batch(all_params, matrix_weather, days_harvest, doy_irr, verbose=verbose, n_threads=3)
+        self.assertTrue(np.array_equal(out, out3, equal_nan=True))
+
+    def test_pool(self):
+        from komanawa.basgra_nz_py.pool import BasgraPool
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        all_params = []
+        for irrigf, lat in zip([0, 0.5, 0.9, 1, 0.25], [-35, -40, -43.6, -46, -41]):
+            p = params.copy()
+            p['IRRIGF'] = irrigf
+            p['LAT'] = lat
+            all_params.append(p)
+        correct = run_basgra_nz_batch(all_params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+        correct_agg = run_basgra_nz_batch(all_params, matrix_weather, days_harvest, doy_irr, verbose=verbose,
+                                          out_vars=['BASAL', 'IRRIG'], aggregate='month')
+
+        with BasgraPool(n_processes=2) as pool:
+            # uneven chunks, the workers write into disjoint runs of the shared output
+            out = pool.run(all_params, matrix_weather, days_harvest, doy_irr, verbose=verbose, chunksize=2)
+            self.assertTrue(np.array_equal(out, correct, equal_nan=True))
+            # the workers are re-used for the next ensemble
+            out = pool.run(all_params, matrix_weather, days_harvest, doy_irr, verbose=verbose,
+                           out_vars=['BASAL', 'IRRIG'], aggregate='month')
+            self.assertTrue(np.array_equal(out, correct_agg, equal_nan=True))
+            out = pool.run(all_params, matrix_weather, days_harvest, doy_irr, verbose=verbose,
+                           out_vars=['BASAL', 'IRRIG'], aggregate='month', record_layout=True)
+            self.assertTrue(np.array_equal(out, correct_agg, equal_nan=True))
+
+    def test_arrays(self):
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        correct_out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+
+        params2 = params.copy()
+        params2['IRRIGF'] = 0.5
+        correct_out2 = run_basgra_nz(params2, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+
+        # pack the inputs once
+        weather = np.asfortranarray(matrix_weather.loc[:, matrix_weather_keys_pet].values, dtype=float)
+        harvest = np.asfortranarray(_trans_manual_harv(days_harvest.loc[:, days_harvest_keys], matrix_weather).values,
+                                    dtype=float)
+        doy_irr = np.array(doy_irr, dtype=np.int32)
+        out = np.zeros((len(weather), len(out_cols)), order='F')
+
+        for p, correct in zip([params, params2], [correct_out, correct_out2]):
+            p = np.array([p[k] for k in param_keys], dtype=float)
+            y = run_basgra_nz_arrays(p, weather, harvest, doy_irr, out=out, verbose=verbose)
+            self.assertIs(y, out)  # results are written into the supplied buffer
+            self._output_checks(pd.DataFrame(out, correct.index, out_cols), correct)
+
+        # inputs which would need to be copied are rejected
+        with self.assertRaises(AssertionError):
+            run_basgra_nz_arrays(p, np.ascontiguousarray(weather), harvest, doy_irr, out=out, verbose=verbose)
+        with self.assertRaises(AssertionError):
+            run_basgra_nz_arrays(p, weather, harvest, doy_irr.astype(np.int64), out=out, verbose=verbose)
+        # the days of year are used as indices in fortran
+        for bad_doy in [367, -1, 100000]:
+            with self.assertRaises(AssertionError):
+                run_basgra_nz_arrays(p, weather, harvest, np.array([bad_doy], np.int32), out=out, verbose=verbose)
+
+    def test_record_layout(self):
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        inputs = ValidatedInputs(matrix_weather, days_harvest, doy_irr)
+        p = np.array([params[k] for k in param_keys], dtype=float)
+        period, _ = _get_agg_periods(inputs.dates, 'month')
+
+        # the record layout holds the same values in C order
+        for kwargs in [{}, {'period': period}]:
+            out = run_basgra_nz_arrays(p, inputs.matrix_weather, inputs.days_harvest, inputs.doy_irr,
+                                       verbose=verbose, **kwargs)
+            rec_out = run_basgra_nz_arrays(p, inputs.matrix_weather, inputs.days_harvest, inputs.doy_irr,
+                                           verbose=verbose, record_layout=True, **kwargs)
+            self.assertTrue(rec_out.flags.c_contiguous)
+            self.assertTrue(np.array_equal(out, rec_out, equal_nan=True))
+
+        with self.assertRaises(AssertionError):  # an F ordered buffer would need to be copied
+            run_basgra_nz_arrays(p, inputs.matrix_weather, inputs.days_harvest, inputs.doy_irr,
+                                 out=np.zeros((len(inputs.dates), len(out_cols)), order='F'), record_layout=True)
+
+        all_params = [params, {**params, 'IRRIGF': 0.5}]
+        for aggregate in [None, 'month']:
+            out = run_basgra_nz_batch(all_params, inputs, verbose=verbose, aggregate=aggregate)
+            rec_out = run_basgra_nz_batch(all_params, inputs, verbose=verbose, aggregate=aggregate,
+                                          record_layout=True)
+            self.assertTrue(np.array_equal(out, rec_out, equal_nan=True))
+
+    def test_harvest_events(self):
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        np.random.seed(3)
+        days_harvest.loc[:, 'weed_dm_frac'] = np.random.rand(len(days_harvest))
+        days_harvest = days_harvest.iloc[::-1]  # unsorted harvest data
+        inputs = ValidatedInputs(matrix_weather, days_harvest, doy_irr)
+
+        # only the harvest events are passed to fortran
+        harvest_day, harvest_events = inputs.days_harvest
+        self.assertEqual(harvest_events.shape, (len(days_harvest), len(days_harvest_keys) - 2))
+        self.assertTrue((np.diff(harvest_day) > 0).all())
+
+        # the sparse events must match the dense (one row per day) harvest data
+        p = np.array([params[k] for k in param_keys], dtype=float)
+        dense = np.asfortranarray(_trans_manual_harv(days_harvest.loc[:, days_harvest_keys], matrix_weather).values,
+                                  dtype=float)
+        out = run_basgra_nz_arrays(p, inputs.matrix_weather, inputs.days_harvest, inputs.doy_irr, verbose=verbose)
+        dense_out = run_basgra_nz_arrays(p, inputs.matrix_weather, dense, inputs.doy_irr, verbose=verbose)
+        self.assertTrue(np.array_equal(out, dense_out, equal_nan=True))
+
+        # the fortran code steps through the events in order, unsorted or out of range days are rejected
+        bad_days = [harvest_day[::-1].copy(), harvest_day - harvest_day[0], harvest_day + len(matrix_weather)]
+        for bad_day in bad_days:
+            with self.assertRaises(AssertionError):
+                run_basgra_nz_arrays(p, inputs.matrix_weather, (bad_day, harvest_events), inputs.doy_irr,
+                                     verbose=verbose)
+
+    def test_out_vars(self):
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        full_out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+
+        out_vars = ['YIELD', 'DM', 'WAL']  # no year/doy, the dates must still be correct
+        out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose, out_vars=out_vars)
+        pd.testing.assert_frame_equal(out, full_out.loc[:, out_vars])
+
+        batch_out = run_basgra_nz_batch([params, params], matrix_weather, days_harvest, doy_irr, verbose=verbose,
+                                        out_vars=out_vars)
+        self.assertEqual(batch_out.shape, (2, len(matrix_weather), len(out_vars)))
+        self.assertTrue(np.array_equal(batch_out[1], full_out.loc[:, out_vars].values, equal_nan=True))
+
+        with self.assertRaises(AssertionError):
+            run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose, out_vars=['DM', 'not_a_var'])
+
+    def test_aggregate(self):
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        out_vars = ['DM', 'YIELD', 'WAL', 'IRRIG', 'RAIN']
+        daily = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose, out_vars=out_vars)
+
+        water_year = daily.index.year - (daily.index.month < 7)
+        groupers = {
+            'month': [daily.index.year, daily.index.month],
+            'water_year': water_year,
+            'year': daily.index.year,
+        }
+        for aggregate, grouper in groupers.items():
+            out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose, out_vars=out_vars,
+                                aggregate=aggregate)
+            expect = daily.groupby(grouper).agg(['sum', 'mean', 'min', 'max'])
+            self.assertEqual(out.shape, expect.shape)
+            self.assertTrue(np.allclose(out.values, expect.values), aggregate)
+            self.assertEqual(list(out.columns), list(expect.columns))
+
+        self.assertEqual(out.index[0], pd.Timestamp(f'{daily.index.year[0]}-01-01'))
+        out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose, out_vars=out_vars,
+                            aggregate='water_year')
+        self.assertEqual(out.index[0], pd.Timestamp(f'{water_year[0]}-07-01'))
+
+        batch_out = run_basgra_nz_batch([params, params], matrix_weather, days_harvest, doy_irr, verbose=verbose,
+                                        out_vars=out_vars, aggregate='water_year')
+        self.assertEqual(batch_out.shape, (2, len(out), len(out_vars), 4))
+        self.assertTrue(np.allclose(batch_out[1].reshape(len(out), -1), out.values))
+
+    def test_year_doy_to_datetime(self):
+        dates = pd.date_range('1899-12-01', '2101-02-01')
+        got = year_doy_to_datetime(dates.year.values, dates.dayofyear.values)
+        self.assertTrue((got == dates).all())
+
+        # 365 day calendar, leap days removed and doy mapped via month and day
+        dates = dates[~((dates.month == 2) & (dates.day == 29))]
+        mapper = get_month_day_to_nonleap_doy()
+        doy = np.array([mapper[(m, d)] for m, d in zip(dates.month, dates.day)])
+        got = year_doy_to_datetime(dates.year.values, doy, run_365_calendar=True)
+        self.assertTrue((got == dates).all())
+
+        with self.assertRaises(AssertionError):
+            year_doy_to_datetime([2021], [366])
+        with self.assertRaises(AssertionError):
+            year_doy_to_datetime([2020], [366], run_365_calendar=True)
+
+    def test_validated_inputs(self):
+        from unittest import mock
+        from komanawa.basgra_nz_py import basgra_python
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        correct_out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+
+        inputs = ValidatedInputs(matrix_weather, days_harvest, doy_irr)
+        with mock.patch.object(basgra_python, '_test_basgra_inputs') as input_test:
+            out = run_basgra_nz(params, inputs, verbose=verbose)
+            batch_out = run_basgra_nz_batch([params, params], inputs, verbose=verbose)
+            input_test.assert_not_called()  # the weather and harvest data are only tested once
+        pd.testing.assert_frame_equal(out, correct_out)
+        self.assertTrue(np.array_equal(batch_out[0], correct_out.values, equal_nan=True))
+
+        # the parameters are still checked
+        bad_params = params.copy()
+        bad_params['reseed_harv_delay'] = 0
+        with self.assertRaises(AssertionError):
+            run_basgra_nz(bad_params, inputs, verbose=verbose)
+
+        # validated inputs cannot be changed or combined with new harvest data
+        with self.assertRaises(ValueError):
+            inputs.matrix_weather[0, 2] = 1
+        with self.assertRaises(AssertionError):
+            run_basgra_nz(params, inputs, days_harvest, doy_irr, verbose=verbose)
+
+    def test_long_run(self):
+        # runs are no longer limited to 100 years (36600 days)
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        short_out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+
+        ndays = 36600 + 730
+        long_weather = matrix_weather.iloc[np.arange(ndays) % len(matrix_weather)].copy()
+        dates = pd.date_range(short_out.index[0], periods=ndays)
+        long_weather.loc[:, 'year'] = dates.year
+        long_weather.loc[:, 'doy'] = dates.dayofyear
+        long_weather.index = dates
+        long_harvest = clean_harvest(days_harvest, long_weather)
+
+        long_out = run_basgra_nz(params, long_weather, long_harvest, doy_irr, verbose=verbose)
+        self.assertEqual(len(long_out), ndays)
+        self.assertFalse(long_out.iloc[-1].isna().all())
+
+        # the start of the long run must match the short run
+        self._output_checks(long_out.iloc[:len(short_out) - 1], short_out.iloc[:-1])
+
+    def test_threaded_runs(self):
+        from concurrent.futures import ThreadPoolExecutor
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+
+        all_params = []
+        for irrigf, lat in zip([0, 0.5, 0.9, 1], [-35, -40, -43.6, -46]):
+            p = params.copy()
+            p['IRRIGF'] = irrigf
+            p['LAT'] = lat
+            all_params.append(p)
+
+        serial = [run_basgra_nz(p, matrix_weather, days_harvest, doy_irr, verbose=verbose) for p in all_params]
+
+        # the model state is thread local, so concurrent runs must not interfere with each other
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            threaded = list(pool.map(lambda p: run_basgra_nz(p, matrix_weather, days_harvest, doy_irr,
+                                                             verbose=verbose), all_params * 3))
+        for i, out in enumerate(threaded):
+            pd.testing.assert_frame_equal(out, serial[i % len(all_params)])
+
+
+    def test_warm_start(self):
+        from komanawa.basgra_nz_py.input_output_keys import state_keys
+        inputs = [establish_org_input()]
+        params, matrix_weather, days_harvest, doy_irr = get_input_for_storage_tests()
+        params['runoff_from_rain'] = 1
+        params['stor_full_refil_doy'] = 240
+        params['I_h2o_store_vol'] = 0.75
+        params['stor_leakage'] = 10
+        matrix_weather.loc[:, 'max_irr'] = 5
+        matrix_weather.loc[:, 'irr_trig_store'] = 1
+        matrix_weather.loc[:, 'irr_targ_store'] = 0
+        matrix_weather.loc[:, 'external_inflow'] = 0
+        inputs.append((params, matrix_weather.loc[:, matrix_weather_keys_pet], days_harvest, doy_irr))
+
+        for params, matrix_weather, days_harvest, doy_irr in inputs:
+            full_out, full_state = run_basgra_nz(params, matrix_weather, clean_harvest(days_harvest, matrix_weather),
+                                                 doy_irr, verbose=verbose, return_state=True)
+            self.assertEqual(list(full_state.index), list(state_keys))
+
+            # split the run into segments, each resumed from the state at the end of the previous one
+            outs = []
+            state = None
+            harvest_dates = year_doy_to_datetime(days_harvest.year.values, days_harvest.doy.values)
+            weather_dates = year_doy_to_datetime(matrix_weather.year.values, matrix_weather.doy.values)
+            for idx in np.array_split(np.arange(len(matrix_weather)), [400, 1000]):
+                weather = matrix_weather.iloc[idx]
+                harvest = days_harvest.loc[(harvest_dates >= weather_dates[idx[0]])
+                                           & (harvest_dates <= weather_dates[idx[-1]])]
+                out, state = run_basgra_nz(params, weather, harvest, doy_irr, verbose=verbose, state=state,
+                                           return_state=True)
+                outs.append(out)
+            self._output_checks(pd.concat(outs), full_out)
+            self.assertTrue(np.allclose(state.values, full_state.values))
+
+        with self.assertRaises(AssertionError):
+            run_basgra_nz(params, matrix_weather, clean_harvest(days_harvest, matrix_weather), doy_irr,
+                          verbose=verbose, state=full_state.drop('YIELD_RYE'))
+
+    def test_step_simulation(self):
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        full_out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+
+        sim = BasgraSimulation(params, days_harvest, doy_irr, verbose=verbose)
+        outs = []
+        start = 0
+        for n_days in [1, 30, 7, 365, 200, len(matrix_weather)]:
+            n_days = min(n_days, len(matrix_weather) - start)
+            outs.append(sim.step(n_days, matrix_weather.iloc[start:start + n_days]))
+            start += n_days
+        self.assertEqual(sim.ndays, len(matrix_weather))
+        self._output_checks(pd.concat(outs), full_out)
+
+        # daily steps, some of which start on a harvest day
+        sim = BasgraSimulation(params, days_harvest, doy_irr, verbose=verbose)
+        outs = [sim.step(1, matrix_weather.iloc[[i]]) for i in range(120)]
+        self._output_checks(pd.concat(outs), full_out.iloc[:120])
+
+        # the weather must continue from the last simulated day
+        sim = BasgraSimulation(params, days_harvest, doy_irr, verbose=verbose)
+        sim.step(10, matrix_weather.iloc[:10])
+        with self.assertRaises(AssertionError):
+            sim.step(10, matrix_weather.iloc[11:21])
+
+        # penman mode, the weather only penman terms are calculated for the rows of each step
+        params, matrix_weather, days_harvest, doy_irr = establish_peyman_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        full_out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose, supply_pet=False)
+        sim = BasgraSimulation(params, days_harvest, doy_irr, supply_pet=False, verbose=verbose)
+        outs = [sim.step(100, matrix_weather.iloc[:100]), sim.step(len(matrix_weather) - 100, matrix_weather.iloc[100:])]
+        self._output_checks(pd.concat(outs), full_out)
+
+    def test_spin_up_cache(self):
+        from komanawa.basgra_nz_py.spin_up import SpinUpCache
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        harvest_dates = year_doy_to_datetime(days_harvest.year.values, days_harvest.doy.values)
+        weather_dates = year_doy_to_datetime(matrix_weather.year.values, matrix_weather.doy.values)
+        spin_weather = matrix_weather.iloc[:730]
+        spin_harvest = days_harvest.loc[harvest_dates <= weather_dates[729]]
+        weather = matrix_weather.iloc[730:]
+        harvest = days_harvest.loc[harvest_dates > weather_dates[729]]
+        full_out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+
+        cache = SpinUpCache(maxsize=2)
+        state = cache.get_state(params, spin_weather, spin_harvest, doy_irr, verbose=verbose)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        for irrigf in [0, 0.5]:  # scenarios sharing the spin up
+            self.assertTrue(np.allclose(cache.get_state(params, spin_weather, spin_harvest, doy_irr), state))
+            p = params.copy()
+            p['IRRIGF'] = irrigf
+            run_basgra_nz(p, weather, harvest, doy_irr, verbose=verbose, state=state)
+        self.assertEqual((cache.hits, cache.misses), (2, 1))
+        out = run_basgra_nz(params, weather, harvest, doy_irr, verbose=verbose, state=state)
+        self._output_checks(out, full_out.iloc[730:])
+
+        # least recently used states are evicted
+        for lat in [-40, -45]:
+            p = params.copy()
+            p['LAT'] = lat
+            cache.get_state(p, spin_weather, spin_harvest, doy_irr)
+        self.assertEqual(len(cache), 2)
+        cache.get_state(params, spin_weather, spin_harvest, doy_irr)
+        self.assertEqual((cache.hits, cache.misses), (2, 4))
+
+        # repeat the spin up until it converges
+        converged = cache.get_state(params, spin_weather, spin_harvest, doy_irr, max_cycles=50, converge_rtol=1e-3)
+        again = run_basgra_nz(params, spin_weather, spin_harvest, doy_irr, verbose=verbose, state=converged,
+                              return_state=True)[1].drop('AGE')
+        self.assertTrue(np.allclose(again, converged.drop('AGE'), rtol=1e-3, atol=1e-6))
+
+    def test_result_cache(self):
+        import tempfile
+        from unittest import mock
+        from komanawa.basgra_nz_py import result_cache
+        params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+        days_harvest = clean_harvest(days_harvest, matrix_weather)
+        correct_out = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+        correct_agg = run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose,
+                                    aggregate='month')
+
+        with tempfile.TemporaryDirectory() as cache_dir:
+            cache = result_cache.ResultCache(cache_dir)
+            out = cache.run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+            pd.testing.assert_frame_equal(out, correct_out)
+
+            # a hit (also from another cache object e.g. in another process) does not run the model
+            with mock.patch.object(result_cache, 'run_basgra_nz') as run:
+                out = result_cache.ResultCache(cache_dir).run_basgra_nz(params, matrix_weather, days_harvest,
+                                                                        doy_irr, verbose=verbose)
+                run.assert_not_called()
+            pd.testing.assert_frame_equal(out, correct_out)
+
+            agg = cache.run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose,
+                                      aggregate='month')
+            pd.testing.assert_frame_equal(agg, correct_agg)
+
+            # a new kernel build or different inputs are not hits
+            with mock.patch.object(result_cache, '_get_kernel_id', return_value='new_kernel'):
+                cache.run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+            p = params.copy()
+            p['IRRIGF'] = 0.5
+            cache.run_basgra_nz(p, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+            self.assertEqual(len(list(cache.cache_dir.glob('*.npz'))), 4)
+
+            # the least recently used results are evicted once the cache is too large
+            result_size = max(path.stat().st_size for path in cache.cache_dir.glob('*.npz'))
+            small = result_cache.ResultCache(cache_dir, max_size_mb=2.5 * result_size / 1024 ** 2)
+            out = small.run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+            pd.testing.assert_frame_equal(out, correct_out)
+            p['IRRIGF'] = 0.25
+            small.run_basgra_nz(p, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+            self.assertLessEqual(small.size(), small.max_size)
+            with mock.patch.object(result_cache, 'run_basgra_nz') as run:
+                small.run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose)
+                run.assert_not_called()
+            small.clear()
+            self.assertEqual(small.size(), 0)
+
+    def test_fortran_module_cache(self):
+        from unittest import mock
+        from komanawa.basgra_nz_py import get_fortran_module
+        first = get_fortran_module.get_fortran_basgra()
+        # the compiler is not probed once the module is cached
+        with mock.patch.object(get_fortran_module.subprocess, 'run') as run:
+            second = get_fortran_module.get_fortran_basgra()
+            run.assert_not_called()
+        self.assertIs(first, second)
+
+        # a single kernel runs both weather modes
+        for supply_pet in [True, False]:
+            if supply_pet:
+                params, matrix_weather, days_harvest, doy_irr = establish_org_input()
+            else:
+                params, matrix_weather, days_harvest, doy_irr = establish_peyman_input()
+            days_harvest = clean_harvest(days_harvest, matrix_weather)
+            with mock.patch.object(get_fortran_module, '_get_source_hash') as source_hash:
+                run_basgra_nz(params, matrix_weather, days_harvest, doy_irr, verbose=verbose, supply_pet=supply_pet)
+                source_hash.assert_not_called()
+
+    def test_make_relocatable(self):
+        import tempfile
+        from pathlib import Path
+        from komanawa.basgra_nz_py import build
+        src = str(build._fortran_dir.joinpath('uncompiled_fortran'))
+        wrapper = f"_ordered_dependencies = ['{src}/plant.f95', 'basgraf.f95']\n"
+        with tempfile.TemporaryDirectory() as tdir:
+            path = Path(tdir).joinpath('__init__.py')
+            path.write_text(wrapper)
+            build._make_relocatable(path)
+            text = path.read_text()
+        # the sources are found relative to the package rather than the build machine
+        self.assertNotIn(src, text)
+        self.assertIn("'../../uncompiled_fortran/plant.f95'", text)
+
+    def test_kernel_cache(self):
+        import tempfile
+        import time
+        from pathlib import Path
+        from unittest import mock
+        from concurrent.futures import ThreadPoolExecutor
+        from komanawa.basgra_nz_py import get_fortran_module
+
+        def fake_compile(output_dir, f_compiler_args, binname, verbose, profile):
+            time.sleep(0.2)
+            Path(output_dir).joinpath('basgraf').mkdir()
+            Path(output_dir).joinpath('basgraf', '__init__.py').write_text('basgramodule = None\n')
+
+        module_name, f_compiler_args = get_fortran_module._get_compile_options()
+        source_hash = get_fortran_module._get_source_hash(module_name, f_compiler_args)
+        with tempfile.TemporaryDirectory() as tdir, mock.patch.dict(os.environ, {'BASGRA_NZ_CACHE_DIR': tdir}), \
+                mock.patch.object(get_fortran_module, '_compile_kernel', side_effect=fake_compile) as compile_kernel:
+            get_kernel = lambda _: get_fortran_module._get_cached_kernel(module_name, f_compiler_args, source_hash,
+                                                                         'gfortran-12', False, False)
+            # concurrent workers compile the kernel exactly once
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                kernel_dirs = set(pool.map(get_kernel, range(8)))
+            self.assertEqual(compile_kernel.call_count, 1)
+            self.assertEqual(len(kernel_dirs), 1)
+            kernel_dir = kernel_dirs.pop()
+            self.assertTrue(kernel_dir.joinpath('__init__.py').exists())
+            self.assertTrue(str(kernel_dir).startswith(tdir))
+            self.assertEqual(sorted(p.name for p in Path(tdir).iterdir() if not p.name.endswith('.lock')),
+                             [kernel_dir.parent.name])  # no temporary build directories left behind
+
+            # recompiling replaces the kernel in place
+            get_fortran_module._get_cached_kernel(module_name, f_compiler_args, source_hash, 'gfortran-12', True, False)
+            self.assertEqual(compile_kernel.call_count, 2)
+            self.assertTrue(kernel_dir.joinpath('__init__.py').exists())
+
+        # sources or flags changes change the hash
+        self.assertNotEqual(source_hash, get_fortran_module._get_source_hash('other', f_compiler_args))
+        self.assertNotEqual(source_hash, get_fortran_module._get_source_hash(module_name, f_compiler_args + ['-O2']))
+
+    def test_build_profiles(self):
+        import subprocess
+        import tempfile
+        from pathlib import Path
+        from unittest import mock
+        from komanawa.basgra_nz_py import get_fortran_module
+
+        module_name, f_compiler_args = get_fortran_module._get_compile_options('fast')
+        self.assertEqual(module_name, 'for_basgra_fast')
+        self.assertIn('-ffast-math', f_compiler_args)
+        with self.assertRaises(AssertionError):
+            get_fortran_module._get_compile_options('unknown')
+
+        def fake_fimport(output_dir, f_compiler_args, binname, verbose):
+            Path(output_dir).joinpath('basgraf').mkdir()
+            Path(output_dir).joinpath('basgraf', '__init__.py').write_text(
+                'if (max(max([0]+[]),\n        ) > os.path.getmtime(_path_to_lib)):\n    print()\n    print("old"')
+
+        # kernels which do not reproduce the regression outputs are not used
+        failed = subprocess.CompletedProcess([], 1, b'', b'FAILED (failures=1)')
+        env = {'BASGRA_NZ_BUILD_PROFILE': 'native'}
+        with tempfile.TemporaryDirectory() as tdir, mock.patch.dict(os.environ, BASGRA_NZ_CACHE_DIR=tdir, **env), \
+                mock.patch.object(get_fortran_module, '_fimport', side_effect=fake_fimport), \
+                mock.patch.object(get_fortran_module, '_check_compiler', side_effect=lambda b: b), \
+                mock.patch.object(get_fortran_module, '_run_with_kernel', return_value=failed) as run_tests:
+            os.environ.pop('BASGRA_NZ_KERNEL_DIR', None)  # set while the build profiles are being checked
+            with self.assertRaises(ValueError):
+                get_fortran_module.get_fortran_basgra()
+            run_tests.assert_called_once()
+            self.assertIn('for_basgra_native', str(run_tests.call_args[0][0]))
+            self.assertEqual([p.name for p in Path(tdir).iterdir() if not p.name.endswith('.lock')], [])
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file